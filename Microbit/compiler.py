@@ -21,14 +21,24 @@ def input_bool(prompt : str, condition_val : str) -> bool:
 
     return input_val.strip().upper() == condition_val.upper()
 
-def flash_file(microbit_name : str, file_path : str):
+def minify_script(lines : list) -> bytes:
+    # comments and long names cost flash and RAM on the micro:bit, so every script is minified before flashing
+    script = python_minifier.minify("".join(lines), rename_locals=True, rename_globals=True)
+    return script.encode("utf-8")
+
+def flash_file(microbit_name : str, file_path : str, radio_group : int | None = None):
     done = False
     while not done:
         input(f"Connect the {microbit_name} Micro:Bit. Press ENTER when ready.")
         if path.isfile(file_path):
             try:
-                uflash.flash(path_to_python=file_path)
-                print(f"Finished flashing {microbit_name} Micro:Bit.")
+                with open(file_path) as f:
+                    python_data = f.readlines()
+                if radio_group is not None:
+                    python_data = set_radio_group(python_data, radio_group)
+                script = minify_script(python_data)
+                uflash.flash(python_script=script)
+                print(f"Finished flashing {microbit_name} Micro:Bit ({len(script)} bytes).")
                 done = True
             except IOError:
                 print("Micro:bit not found. Are you sure it's plugged in?")
@@ -46,10 +56,18 @@ def search_for_tag(lines : list, tag : str):
         
     return tag_line
         
-def flash_buzzers(start : int, end : int, file_path : str):
+def set_radio_group(lines : list, group : int) -> list:
+    tag_line = search_for_tag(lines, '#GROUP#')
+    if tag_line is not None:
+        lines = lines.copy()
+        lines[tag_line] = re.sub(r'=\s*\d+', f'= {group}', lines[tag_line], count=1)
+        
+    return lines
+        
+def flash_buzzers(start : int, end : int, file_path : str, radio_group : int):
     if path.isfile(file_path):
         with open(file_path) as f:
-            python_data = f.readlines()
+            python_data = set_radio_group(f.readlines(), radio_group)
     else:
         raise FileNotFoundError(f"Required file '{file_path}' was not found.")
         
@@ -61,11 +79,10 @@ def flash_buzzers(start : int, end : int, file_path : str):
         if tag_line is not None:
             file_to_flash[tag_line] = file_to_flash[tag_line].replace('"#REPLACE#"', str(i))
             
-        file_to_flash = "\n".join(file_to_flash)
-        file_to_flash = python_minifier.minify(file_to_flash, rename_locals=True, rename_globals=True)
+        script = minify_script(file_to_flash)
         
-        uflash.flash(python_script=file_to_flash.encode("utf-8"))
-        print(f"Finished flashing Buzzer {i} to Micro:Bit.")
+        uflash.flash(python_script=script)
+        print(f"Finished flashing Buzzer {i} to Micro:Bit ({len(script)} bytes).")
         
 def main():
     print("Buzzer System - Micro:Bit Setup Aid")
@@ -86,21 +103,22 @@ def main():
     
     start = input_int("Start from which index? [0-15] ", 0, 15)
     end = input_int(f"End at which index? [{start}-15] ", start, 15)
+    radio_group = input_int("Radio group? Use a different group for each system in the same room. [0-255] ", 0, 255)
     #flash_test = not input_bool("Flash buzzers with test script? [Y/N]", "N")
     
     # Flash controller and host buzzer
     print("---------------------------------------")
     print("Flash Controller & Host Buzzer:")
     if flash_controller:
-        flash_file("Controller", "src/controller.py")
+        flash_file("Controller", "src/controller.py", radio_group)
     
     if flash_host_buzzer:
-        flash_file("Host Buzzer", "src/buzzer_host.py")
+        flash_file("Host Buzzer", "src/buzzer_host.py", radio_group)
     
     # Flash buzzers
     print("---------------------------------------")
     print("Flash Buzzers:")
-    flash_buzzers(start, end, "src/buzzer.py")
+    flash_buzzers(start, end, "src/buzzer.py", radio_group)
     
     # End
     print("---------------------------------------")
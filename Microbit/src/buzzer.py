@@ -1,14 +1,54 @@
 import radio #type: ignore
 from microbit import button_a, button_b, pin1, pin0, display, pin2 #type: ignore
 from neopixel import NeoPixel
-from time import sleep_ms
+from time import ticks_ms, ticks_us, ticks_add, ticks_diff
 
 BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
 RED = (255, 0, 0)
 GREEN = (0, 255, 0)
 BLUE = (0, 0, 255)
 ORANGE = (255, 165, 0)
 
+RADIO_GROUP = 16 #GROUP# set by compiler.py when flashing
+
+# Controller packets are [sequence, command, args...], acked with [0, 95, sequence, ID]
+# Packets from buzzers use sequence 0, and aren't acknowledged
+ACK_COMMAND = 95
+ADDRESSED_COMMANDS = (55, 60, 80, 150) # only the buzzer named in the first argument acts on these, so only it acks
+ACK_SLOT = 2 # ms per buzzer ID to wait before acking a broadcast, so acks from different buzzers don't collide
+HEARTBEAT_COMMAND = 100
+PRESENCE_COMMAND = 105
+GROUP_COMMAND = 115 # [115, group], switched to once the ack for it has gone out
+DIAGNOSTIC_COMMAND = 120
+DIAGNOSTIC_REPORT = 125 # [0, 125, ID, press to send us, longest loop us, duplicates], 2 bytes each
+RECENT_SEQUENCES = 8 # sequences remembered, so a retransmission that arrives after newer messages still isn't run twice
+FIRMWARE_VERSION = 7 # reported in presence replies, so the host can spot buzzers running old firmware
+STATE_CODES = {"inactive": 0, "waiting": 1, "active": 2, "locked": 3}
+ROSTER_COMMAND = 110 # [110, team ID for pin 0, ..., team ID for pin 24], 255 for buzzers not in the setup
+NO_TEAM = 255
+REBOOT_COMMAND = 130 # [0, 130, ID, team ID, firmware version], repeated after startup until the team is resent
+REBOOT_RETRY_INTERVAL = 500 # ms
+MAX_REBOOT_ANNOUNCEMENTS = 5
+SURVEY_PING = 135 # [0, 135, survey ID, ping number], counted along with its signal strength
+SURVEY_REPORT_REQUEST = 140 # [0, 140, survey ID], answered in this buzzer's ack slot
+SURVEY_REPORT = 145 # [0, 145, ID, survey ID, pings received, -average RSSI, -weakest RSSI]
+FALSE_START_COMMAND = 150 # [0, 150, ID, ms since open (2 bytes)], sent instead of a buzz within the lockout
+
+CONFIG_FILE = "buzzer.cfg" # team ID, radio group and colour profile, so they survive a power cycle, the lock comes from the next open
+
+BUZZ_RETRY_INTERVAL = 40 # ms between repeats of a buzz until the controller answers it
+MAX_BUZZ_ATTEMPTS = 5
+DEBOUNCE = 20 # ms the button pin must be released before another press counts
+
+FRAME_INTERVAL = 40 # ms between animation frames
+PULSE_PERIOD = 1600 # ms for one breath of the waiting pulse
+PULSE_MIN = 64 # brightness out of 255 at the dimmest point of the pulse
+FLASH_TIME = 300 # ms of flashing when the buzzer activates
+FLASH_STEP = 75
+FADE_TIME = 500 # ms to fade into the locked colour
+STATE_EFFECTS = {"waiting": "pulse", "active": "flash", "locked": "fade"}
+
 class ColorProfile:
     def __init__(self, inactiveColor, waitingColor, activeColor, lockedColor):
         self.__inactiveColor = inactiveColor
@@ -30,30 +70,164 @@ class ColorProfile:
         
 DEFAULT_COLOR_PROFILE = ColorProfile(ORANGE, BLUE, GREEN, BLACK)
 
+class PixelAnimator:
+    # pushes frames from the main loop, skipping any that match what's shown
+    # at most one frame is pushed per call, so an animation never holds up radio or button handling
+    def __init__(self, pixels, pixelCount):
+        self.__pixels = pixels
+        self.__pixelCount = pixelCount
+
+        self.__color = None
+        self.__effect = None
+        self.__fromColor = BLACK
+        self.__shown = None
+        self.__startedAt = ticks_ms()
+        self.__nextFrameAt = None
+
+    def set(self, color, effect=None):
+        color = tuple(color)
+        if color == self.__color and effect == self.__effect: # repeated state messages don't restart the effect
+            return
+
+        self.__fromColor = self.__shown if self.__shown is not None else BLACK
+        self.__color = color
+        self.__effect = effect
+        self.__startedAt = ticks_ms()
+        self.__nextFrameAt = self.__startedAt
+
+    def redraw(self):
+        self.__shown = None
+        self.__nextFrameAt = ticks_ms()
+
+    @staticmethod
+    def scale(color, level):
+        return tuple(value * level // 255 for value in color)
+
+    def frame(self, elapsed):
+        # the colour to show this far into the effect, and whether the effect needs more frames
+        if self.__effect == "pulse": # breathe between full and dim brightness
+            phase = elapsed % PULSE_PERIOD
+            half = PULSE_PERIOD // 2
+            distance = half - phase if phase < half else phase - half
+            return self.scale(self.__color, PULSE_MIN + (255 - PULSE_MIN) * distance // half), True
+        elif self.__effect == "flash" and elapsed < FLASH_TIME: # alternate white and the colour, then hold the colour
+            return (WHITE if (elapsed // FLASH_STEP) % 2 == 0 else self.__color), True
+        elif self.__effect == "fade" and elapsed < FADE_TIME: # blend from the previous colour
+            return tuple(start + (end - start) * elapsed // FADE_TIME for start, end in zip(self.__fromColor, self.__color)), True
+        return self.__color, False
+
+    def update(self):
+        if self.__nextFrameAt is None:
+            return
+
+        now = ticks_ms()
+        if ticks_diff(now, self.__nextFrameAt) < 0:
+            return
+
+        color, animating = self.frame(ticks_diff(now, self.__startedAt))
+        if color != self.__shown:
+            for i in range(self.__pixelCount):
+                self.__pixels[i] = color
+            self.__pixels.show() # type: ignore
+            self.__shown = color
+
+        self.__nextFrameAt = ticks_add(now, FRAME_INTERVAL) if animating else None
+
 class Buzzer:
     def __init__(self, id, buttonPin, neopixelPin, pixelCount):
         # setup the radio module
-        radio.config(group=16, power=7)
+        radio.config(group=RADIO_GROUP, power=7, length=64) # the length must match the controller's, or the roster is dropped
         radio.on()
 
         self.__buttonPin = buttonPin
 
         self.__displayPixels = True
-        self.__pixelCount = pixelCount
-        self.__pixels = NeoPixel(neopixelPin, pixelCount)
+        self.__pixels = PixelAnimator(NeoPixel(neopixelPin, pixelCount), pixelCount)
         self.displayColor(ORANGE)
 
         self.__ID = id # get the ID before continuing with initialisation
         self.__idString = str(hex(self.__ID))[2].upper()
 
         self.__state = "inactive"
+        self.__openedAt = None # when the controller first sent the latest open
+        self.__lockoutUntil = None # presses before this lock the buzzer as a false start
+
+        self.__recentSequences = []
+        self.__duplicates = 0 # packets dropped since startup, for diagnostics
+        self.__ackDelay = self.__ID * ACK_SLOT
+        self.__pendingAcks = [] # (time due, sequence) for acks waiting for this buzzer's slot
+        self.__buzzPacket = None
+        self.__buzzAttempts = 0
+        self.__buzzRetryAt = None
+        self.__presenceDueAt = None
+        self.__pendingGroup = None
+        self.__diagnosticDueAt = None
+
+        self.__surveyID = None
+        self.__surveyReceived = 0
+        self.__surveyRssiTotal = 0
+        self.__surveyRssiMin = 0
+        self.__surveyReportDueAt = None
+
+        self.__pinHeld = False
+        self.__pinReleasedAt = ticks_add(ticks_ms(), -DEBOUNCE)
+        self.__pressToSend = 0 # us from noticing the latest press to its buzz being sent
+        self.__loopStart = None
+        self.__maxLoop = 0 # us, the longest a press can wait to be noticed
         self.__locked = False
 
         self.__teamID = None
+        self.__radioGroup = RADIO_GROUP # the group last switched to, restored at boot so the buzzer can still hear the controller
         self.__colorProfile = DEFAULT_COLOR_PROFILE
+        self.__profileData = None # the 12 colour values last loaded, kept so they can be saved
+        self.__savedConfig = None
+        self.__configChanged = False
+        self.loadConfig()
+
+        self.__announceAt = ticks_add(ticks_ms(), self.__ackDelay)
+        self.__announcements = 0
         
         pin2.write_digital(1)
 
+    def loadConfig(self):
+        try:
+            with open(CONFIG_FILE) as f:
+                values = [int(value) for value in f.read().split()]
+        except (OSError, ValueError): # nothing saved yet
+            return
+
+        if len(values) != 2 and len(values) != 14:
+            return
+
+        self.__teamID = None if values[0] == NO_TEAM else values[0]
+        self.__radioGroup = values[1]
+        radio.config(group=self.__radioGroup)
+        if len(values) == 14:
+            self.loadProfile(values[2:14])
+        self.__savedConfig = values
+        self.__configChanged = False
+        self.updatePixels()
+
+    def saveConfig(self):
+        # only rewritten when something has changed, as flash writes are slow
+        values = [self.__teamID if self.__teamID is not None else NO_TEAM, self.__radioGroup] + (self.__profileData or [])
+        if values != self.__savedConfig:
+            with open(CONFIG_FILE, "w") as f:
+                f.write(" ".join(str(value) for value in values))
+            self.__savedConfig = values
+        self.__configChanged = False
+
+    def setTeam(self, teamID):
+        self.__teamID = teamID
+        self.__configChanged = True
+        self.__announceAt = None # the controller knows about this buzzer again
+        self.updatePixels()
+
+    def sendRebootAnnouncement(self):
+        radio.send_bytes(bytes([0, REBOOT_COMMAND, self.__ID, self.__teamID if self.__teamID is not None else NO_TEAM, FIRMWARE_VERSION]))
+        self.__announcements += 1
+        self.__announceAt = ticks_add(ticks_ms(), REBOOT_RETRY_INTERVAL) if self.__announcements < MAX_REBOOT_ANNOUNCEMENTS else None
+
     def open(self):
         if self.__locked: # only open the buzer if it wasn't already locked
             self.__state = "locked"
@@ -62,6 +236,89 @@ class Buzzer:
 
         self.updatePixels()
 
+    def receivePacket(self, radioData):
+        # returns True if the command should be run, scheduling any ack
+        sequence = radioData[0]
+        if sequence == 0: # from another buzzer, or a heartbeat from the controller
+            if len(radioData) > 1 and radioData[1] == HEARTBEAT_COMMAND:
+                self.__presenceDueAt = ticks_add(ticks_ms(), self.__ackDelay) # reply in this buzzer's slot, like an ack
+            return False # another buzzer's press doesn't close this one, the controller's ranked [50, winner] does
+
+        if radioData[1] in ADDRESSED_COMMANDS:
+            if len(radioData) < 3 or radioData[2] != self.__ID:
+                return False
+            self.__pendingAcks.append((ticks_ms(), sequence))
+        else:
+            self.__pendingAcks.append((ticks_add(ticks_ms(), self.__ackDelay), sequence))
+
+        # the controller has answered a buzz (50 or 55) or a false start (150), so stop repeating ours
+        if self.__buzzPacket is not None and radioData[1] in ((FALSE_START_COMMAND,) if self.__buzzPacket[1] == FALSE_START_COMMAND else (50, 55)):
+            self.__buzzRetryAt = None
+
+        if sequence in self.__recentSequences: # the controller didn't get our ack, so ack again without running the command twice
+            self.__duplicates += 1
+            return False
+        self.__recentSequences.append(sequence)
+        if len(self.__recentSequences) > RECENT_SEQUENCES:
+            self.__recentSequences.pop(0)
+        return True
+
+    def sendDueAcks(self):
+        now = ticks_ms()
+        for ack in self.__pendingAcks[:]:
+            if ticks_diff(now, ack[0]) >= 0:
+                radio.send_bytes(bytes([0, ACK_COMMAND, ack[1], self.__ID]))
+                self.__pendingAcks.remove(ack)
+
+    def sendPresence(self):
+        radio.send_bytes(bytes([0, PRESENCE_COMMAND, self.__ID, self.__teamID if self.__teamID is not None else 255, STATE_CODES[self.__state], FIRMWARE_VERSION, 1 if self.__locked else 0]))
+        self.__presenceDueAt = None
+
+    def buttonPressed(self):
+        # presses are edge triggered, so holding the button through an open doesn't buzz
+        # button A latches its presses between loops, the pin is sampled every loop and debounced on release
+        pressed = button_a.was_pressed()
+        if self.__buttonPin.read_digital():
+            if not self.__pinHeld and ticks_diff(ticks_ms(), self.__pinReleasedAt) >= DEBOUNCE:
+                pressed = True
+            self.__pinHeld = True
+        elif self.__pinHeld:
+            self.__pinHeld = False
+            self.__pinReleasedAt = ticks_ms()
+        return pressed
+
+    def sendDiagnostic(self):
+        pressToSend = min(self.__pressToSend, 0xFFFF)
+        maxLoop = min(self.__maxLoop, 0xFFFF)
+        duplicates = min(self.__duplicates, 0xFFFF)
+        radio.send_bytes(bytes([0, DIAGNOSTIC_REPORT, self.__ID, pressToSend & 0xFF, pressToSend >> 8, maxLoop & 0xFF, maxLoop >> 8, duplicates & 0xFF, duplicates >> 8]))
+        self.__diagnosticDueAt = None
+        self.__maxLoop = 0
+
+    def receiveSurveyPing(self, surveyID, rssi):
+        if surveyID != self.__surveyID:
+            self.startSurvey(surveyID)
+        self.__surveyReceived += 1
+        self.__surveyRssiTotal += rssi
+        self.__surveyRssiMin = min(self.__surveyRssiMin, rssi)
+
+    def startSurvey(self, surveyID):
+        self.__surveyID = surveyID
+        self.__surveyReceived = 0
+        self.__surveyRssiTotal = 0
+        self.__surveyRssiMin = 0
+
+    def sendSurveyReport(self):
+        # RSSI is in negative dBm, so it's sent as its magnitude
+        average = -(self.__surveyRssiTotal // self.__surveyReceived) if self.__surveyReceived > 0 else 0
+        radio.send_bytes(bytes([0, SURVEY_REPORT, self.__ID, self.__surveyID, min(self.__surveyReceived, 255), min(average, 255), min(-self.__surveyRssiMin, 255)]))
+        self.__surveyReportDueAt = None
+
+    def sendBuzz(self):
+        radio.send_bytes(self.__buzzPacket) # broadcast event to controller and other buzzers (to tell them to deactive)
+        self.__buzzAttempts += 1
+        self.__buzzRetryAt = ticks_add(ticks_ms(), BUZZ_RETRY_INTERVAL)
+
     def close(self):
         self.__state = "inactive"
         self.updatePixels()
@@ -70,21 +327,19 @@ class Buzzer:
         # get the correct color from ColorProfile object, and make the neopixels display it
         if self.__displayPixels and self.__teamID is not None:
             color = self.__colorProfile.get(self.__state)
-            self.displayColor(color)
+            self.__pixels.set(color, STATE_EFFECTS.get(self.__state))
         else:
             self.displayColor(BLACK)
 
     def displayColor(self, color):
-        for i in range(self.__pixelCount):
-            self.__pixels[i] = color
-        self.__pixels.show() # type: ignore
+        self.__pixels.set(color)
 
     def resetLock(self):
         self.__locked = False
         self.close()
 
-    def lock(self):
-        self.__locked = True
+    def setLocked(self, locked):
+        self.__locked = locked
 
     def toggleLight(self, state=None):
         if state is not None:
@@ -99,40 +354,96 @@ class Buzzer:
         self.updatePixels()
         
     def loadProfile(self, profileData):
+        self.__profileData = list(map(int, profileData[0:12]))
+        self.__configChanged = True
         self.__colorProfile = ColorProfile(list(map(int, profileData[0:3])), list(map(int, profileData[3:6])), list(map(int, profileData[6:9])), list(map(int, profileData[9:12])))
         self.updatePixels()
 
     def mainloop(self):
         while True:
-            if (button_a.is_pressed() or self.__buttonPin.read_digital()) and self.__state == "waiting": # if the button is pressed and the state is waiting, the buzzer has been pressed and should activate
-                self.setActive()
-                
-                for i in range(3):
-                    radio.send_bytes(bytes([50, self.__ID])) # broadcast event to controller and other buzzers (to tell them to deactive)
-                    sleep_ms(10)
+            loopStart = ticks_us()
+            if self.__loopStart is not None:
+                self.__maxLoop = max(self.__maxLoop, ticks_diff(loopStart, self.__loopStart))
+            self.__loopStart = loopStart
+
+            if self.buttonPressed() and self.__state == "waiting": # if the button is pressed and the state is waiting, the buzzer has been pressed and should activate
+                # include ms since opening, so the controller can rank close presses
+                elapsed = min(max(ticks_diff(ticks_ms(), self.__openedAt), 0), 0xFFFF) if self.__openedAt is not None else 0xFFFF
+                if self.__lockoutUntil is not None and ticks_diff(ticks_ms(), self.__lockoutUntil) < 0: # pressed before the cue, so lock without buzzing
+                    self.__buzzPacket = bytes([0, FALSE_START_COMMAND, self.__ID, elapsed & 0xFF, elapsed >> 8])
+                    self.__buzzAttempts = 0
+                    self.sendBuzz()
+                    self.setLocked(True)
+                    self.open() # shows the locked colour until the lock is reset
+                else:
+                    self.__buzzPacket = bytes([0, 50, self.__ID, elapsed & 0xFF, elapsed >> 8])
+                    self.__buzzAttempts = 0
+                    self.sendBuzz() # sent before the neopixels are updated, as pushing them takes time
+                    self.__pressToSend = ticks_diff(ticks_us(), loopStart)
+
+                    self.setActive()
+
+            # repeat the buzz or false start until answered, or the state changes
+            if self.__buzzRetryAt is not None and ticks_diff(ticks_ms(), self.__buzzRetryAt) >= 0:
+                if self.__state == ("locked" if self.__buzzPacket[1] == FALSE_START_COMMAND else "active") and self.__buzzAttempts < MAX_BUZZ_ATTEMPTS:
+                    self.sendBuzz()
+                else:
+                    self.__buzzRetryAt = None
+
+            self.sendDueAcks()
+            if self.__pendingGroup is not None and len(self.__pendingAcks) == 0:
+                radio.config(group=self.__pendingGroup)
+                self.__radioGroup = self.__pendingGroup
+                self.__configChanged = True
+                self.__pendingGroup = None
+
+            if self.__presenceDueAt is not None and ticks_diff(ticks_ms(), self.__presenceDueAt) >= 0:
+                self.sendPresence()
+            if self.__diagnosticDueAt is not None and ticks_diff(ticks_ms(), self.__diagnosticDueAt) >= 0:
+                self.sendDiagnostic()
+            if self.__surveyReportDueAt is not None and ticks_diff(ticks_ms(), self.__surveyReportDueAt) >= 0:
+                self.sendSurveyReport()
+
+            if self.__announceAt is not None and ticks_diff(ticks_ms(), self.__announceAt) >= 0:
+                self.sendRebootAnnouncement()
+            if self.__configChanged and self.__state != "waiting": # never hold up a press with a flash write
+                self.saveConfig()
+
+            self.__pixels.update()
                     
-            if button_b.is_pressed():
-                display.show(self.__idString, delay=1000, clear=True)
+            if button_b.was_pressed():
+                display.show(self.__idString, delay=1000, wait=False, clear=True) # cleared in the background, so the loop keeps running
                     
-            radioData = radio.receive_bytes()
-            if not radioData:
+            packet = radio.receive_full() # (bytes, RSSI, timestamp), the RSSI is only needed for surveys
+            if not packet:
                 continue
+            radioData = packet[0]
+            if len(radioData) >= 3 and radioData[0] == 0 and radioData[1] == SURVEY_PING:
+                self.receiveSurveyPing(radioData[2], packet[1])
+                continue
+            if len(radioData) >= 3 and radioData[0] == 0 and radioData[1] == SURVEY_REPORT_REQUEST:
+                if radioData[2] != self.__surveyID: # none of the pings arrived
+                    self.startSurvey(radioData[2])
+                self.__surveyReportDueAt = ticks_add(ticks_ms(), self.__ackDelay)
+                continue
+            if not self.receivePacket(radioData):
+                continue
+            radioData = radioData[1:] # drop the sequence number
 
             if self.__teamID != None: # these are all commands that require team affiliation, so if the team hasn't been setup, there's no point checking them
-                if radioData[0] == 10:
+                if radioData[0] == 10 or radioData[0] == 25 or radioData[0] == 30 or radioData[0] == 35:
+                    self.__openedAt = ticks_add(ticks_ms(), -radioData[-1]) # the last byte is how long the controller had been sending this open
+                    lockout = radioData[-3] | (radioData[-2] << 8) # the false-start lockout in ms comes before it
+                    self.__lockoutUntil = ticks_add(self.__openedAt, lockout) if lockout > 0 else None
+                    # and before that, every locked buzzer as a bitmap, which sets this buzzer's lock whatever it missed before
+                    self.setLocked((radioData[-7 + self.__ID // 8] >> (self.__ID % 8)) & 1 == 1)
+
+                if radioData[0] == 10 or radioData[0] == 25 or radioData[0] == 30:
                     self.open()
                 elif radioData[0] == 15:
                     self.close()
                 elif radioData[0] == 20: # disable the lock - if active, normally used at the end of questions
                     self.resetLock()
-                elif radioData[0] == 25: # open the buzzer, but lock if the given teamID matches this buzzer's
-                    if radioData[1] == self.__teamID:
-                        self.lock()
-                    self.open()
-                elif radioData[0] == 30: # open the buzzer, but lock if it was currently active
-                    if self.__state == "active":
-                        self.lock()
-                    self.open()
                 elif radioData[0] == 35: # only open the buzzer if the buzzer's teamID matches the one supplied
                     if radioData[1] == self.__teamID:
                         self.open()
@@ -160,11 +471,16 @@ class Buzzer:
             elif radioData[0] == 70: # set whether the neopixels should display or not
                 self.toggleLight(radioData[1])
             elif radioData[0] == 45: # update the neopixels, if an error occured
+                self.__pixels.redraw()
                 self.updatePixels()
             elif radioData[0] == 60: # set the teamID of the buzzer
                 if radioData[1] == self.__ID: # only do this if the supplied buzzerID matches this buzzer's
-                    self.__teamID = int(radioData[2])
-                    self.updatePixels()
+                    self.setTeam(int(radioData[2]))
+            elif radioData[0] == ROSTER_COMMAND: # set the teamID of the buzzer from its entry in the roster
+                if self.__ID + 1 < len(radioData) and radioData[self.__ID + 1] != NO_TEAM:
+                    self.setTeam(radioData[self.__ID + 1])
+                else: # left out of the roster, so behave as if NOT_NEEDED was sent
+                    self.setTeam(None)
             elif radioData[0] == 75: # used to identify a single buzzer to the host and audience
                 if radioData[1] == self.__ID:
                     self.setActive()
@@ -172,8 +488,11 @@ class Buzzer:
                     self.close()
             elif radioData[0] == 80:
                 if radioData[1] == self.__ID:
-                    self.__teamID = None
-                    self.updatePixels()
+                    self.setTeam(None)
+            elif radioData[0] == GROUP_COMMAND: # move to a new radio group, along with the controller
+                self.__pendingGroup = radioData[1]
+            elif radioData[0] == DIAGNOSTIC_COMMAND: # report button timings in this buzzer's slot, after the ack
+                self.__diagnosticDueAt = ticks_add(ticks_ms(), self.__ackDelay)
 
 buzzer = Buzzer("#REPLACE#", pin1, pin0, 7) # setup buzzer object
 
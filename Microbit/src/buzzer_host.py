@@ -1,14 +1,46 @@
 import radio #type: ignore
 from microbit import button_a, pin1, pin0 #type: ignore
 from neopixel import NeoPixel
-from time import sleep_ms
+from time import ticks_ms, ticks_us, ticks_add, ticks_diff
 
 BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
 RED = (255, 0, 0)
 GREEN = (0, 255, 0)
 BLUE = (0, 0, 255)
 PURPLE = (128, 0, 128)
 
+RADIO_GROUP = 16 #GROUP# set by compiler.py when flashing
+
+# Controller packets are [sequence, command, args...], acked with [0, 95, sequence, ID]
+# Packets from buzzers use sequence 0, and aren't acknowledged
+ACK_COMMAND = 95
+ADDRESSED_COMMANDS = (55, 60, 80) # only the buzzer named in the first argument acts on these, so only it acks
+ACK_SLOT = 2 # ms per buzzer ID to wait before acking a broadcast, so acks from different buzzers don't collide
+HOST_ACK_SLOT = 25 # the slot after pin indexes 0-24
+HEARTBEAT_COMMAND = 100
+PRESENCE_COMMAND = 105
+GROUP_COMMAND = 115 # [115, group], switched to once the ack for it has gone out
+DIAGNOSTIC_COMMAND = 120
+DIAGNOSTIC_REPORT = 125 # [0, 125, ID, press to send us, longest loop us, duplicates], 2 bytes each
+RECENT_SEQUENCES = 8 # sequences remembered, so a retransmission that arrives after newer messages still isn't run twice
+FIRMWARE_VERSION = 3 # reported in presence replies, so the host can spot buzzers running old firmware
+STATE_CODES = {"inactive": 0, "waiting": 1, "active": 2, "locked": 3}
+
+CONFIG_FILE = "buzzer.cfg" # the radio group last switched to, so a restart doesn't go back to the flashed one
+
+BUZZ_RETRY_INTERVAL = 40 # ms between repeats of a buzz until the controller answers it
+MAX_BUZZ_ATTEMPTS = 5
+DEBOUNCE = 20 # ms the button pin must be released before another press counts
+
+FRAME_INTERVAL = 40 # ms between animation frames
+PULSE_PERIOD = 1600 # ms for one breath of the waiting pulse
+PULSE_MIN = 64 # brightness out of 255 at the dimmest point of the pulse
+FLASH_TIME = 300 # ms of flashing when the buzzer activates
+FLASH_STEP = 75
+FADE_TIME = 500 # ms to fade into the locked colour
+STATE_EFFECTS = {"waiting": "pulse", "active": "flash", "locked": "fade"}
+
 class ColorProfile:
     def __init__(self, inactiveColor, waitingColor, activeColor, lockedColor):
         self.__inactiveColor = inactiveColor
@@ -30,29 +62,184 @@ class ColorProfile:
 
 DEFAULT_COLOR_PROFILE = ColorProfile(GREEN, BLUE, PURPLE, BLACK) # default color palette is all off, so the neopixels aren't on before the buzzer is properly initialised
 
+class PixelAnimator:
+    # pushes frames from the main loop, skipping any that match what's shown
+    # at most one frame is pushed per call, so an animation never holds up radio or button handling
+    def __init__(self, pixels, pixelCount):
+        self.__pixels = pixels
+        self.__pixelCount = pixelCount
+
+        self.__color = None
+        self.__effect = None
+        self.__fromColor = BLACK
+        self.__shown = None
+        self.__startedAt = ticks_ms()
+        self.__nextFrameAt = None
+
+    def set(self, color, effect=None):
+        color = tuple(color)
+        if color == self.__color and effect == self.__effect: # repeated state messages don't restart the effect
+            return
+
+        self.__fromColor = self.__shown if self.__shown is not None else BLACK
+        self.__color = color
+        self.__effect = effect
+        self.__startedAt = ticks_ms()
+        self.__nextFrameAt = self.__startedAt
+
+    def redraw(self):
+        self.__shown = None
+        self.__nextFrameAt = ticks_ms()
+
+    @staticmethod
+    def scale(color, level):
+        return tuple(value * level // 255 for value in color)
+
+    def frame(self, elapsed):
+        # the colour to show this far into the effect, and whether the effect needs more frames
+        if self.__effect == "pulse": # breathe between full and dim brightness
+            phase = elapsed % PULSE_PERIOD
+            half = PULSE_PERIOD // 2
+            distance = half - phase if phase < half else phase - half
+            return self.scale(self.__color, PULSE_MIN + (255 - PULSE_MIN) * distance // half), True
+        elif self.__effect == "flash" and elapsed < FLASH_TIME: # alternate white and the colour, then hold the colour
+            return (WHITE if (elapsed // FLASH_STEP) % 2 == 0 else self.__color), True
+        elif self.__effect == "fade" and elapsed < FADE_TIME: # blend from the previous colour
+            return tuple(start + (end - start) * elapsed // FADE_TIME for start, end in zip(self.__fromColor, self.__color)), True
+        return self.__color, False
+
+    def update(self):
+        if self.__nextFrameAt is None:
+            return
+
+        now = ticks_ms()
+        if ticks_diff(now, self.__nextFrameAt) < 0:
+            return
+
+        color, animating = self.frame(ticks_diff(now, self.__startedAt))
+        if color != self.__shown:
+            for i in range(self.__pixelCount):
+                self.__pixels[i] = color
+            self.__pixels.show() # type: ignore
+            self.__shown = color
+
+        self.__nextFrameAt = ticks_add(now, FRAME_INTERVAL) if animating else None
+
 class HostBuzzer:
     def __init__(self, buttonPin, neopixelPin, pixelCount):
         # setup the radio module
-        radio.config(group=16, power=7)
+        radio.config(group=RADIO_GROUP, power=7, length=64) # the length must match the controller's, or the roster is dropped
         radio.on()
 
         self.__buttonPin = buttonPin
 
         self.__displayPixels = True
-        self.__pixelCount = pixelCount
-        self.__pixels = NeoPixel(neopixelPin, pixelCount)
+        self.__pixels = PixelAnimator(NeoPixel(neopixelPin, pixelCount), pixelCount)
         self.displayColor(GREEN)
 
         self.__ID = 255 # get the ID before continuing with initialisation
 
         self.__state = "inactive"
+        self.__openedAt = None # when the controller first sent the latest open
+
+        self.__recentSequences = []
+        self.__duplicates = 0 # packets dropped since startup, for diagnostics
+        self.__ackDelay = HOST_ACK_SLOT * ACK_SLOT
+        self.__pendingAcks = [] # (time due, sequence) for acks waiting for this buzzer's slot
+        self.__buzzPacket = None
+        self.__buzzAttempts = 0
+        self.__buzzRetryAt = None
+        self.__presenceDueAt = None
+        self.__pendingGroup = None
+        self.__diagnosticDueAt = None
+
+        self.__pinHeld = False
+        self.__pinReleasedAt = ticks_add(ticks_ms(), -DEBOUNCE)
+        self.__pressToSend = 0 # us from noticing the latest press to its buzz being sent
+        self.__loopStart = None
+        self.__maxLoop = 0 # us, the longest a press can wait to be noticed
 
         self.__colorProfile = DEFAULT_COLOR_PROFILE
+        self.loadGroup()
+
+    def loadGroup(self):
+        try:
+            with open(CONFIG_FILE) as f:
+                radio.config(group=int(f.read()))
+        except (OSError, ValueError): # nothing saved yet
+            pass
+
+    def saveGroup(self, group):
+        with open(CONFIG_FILE, "w") as f:
+            f.write(str(group))
 
     def open(self):
         self.__state = "waiting"
         self.updatePixels()
 
+    def receivePacket(self, radioData):
+        # returns True if the command should be run, scheduling any ack
+        sequence = radioData[0]
+        if sequence == 0: # from another buzzer, or a heartbeat from the controller
+            if len(radioData) > 1 and radioData[1] == HEARTBEAT_COMMAND:
+                self.__presenceDueAt = ticks_add(ticks_ms(), self.__ackDelay) # reply in this buzzer's slot, like an ack
+            return False # another buzzer's press doesn't close this one, the controller's ranked [50, winner] does
+
+        if radioData[1] in ADDRESSED_COMMANDS:
+            if len(radioData) < 3 or radioData[2] != self.__ID:
+                return False
+            self.__pendingAcks.append((ticks_ms(), sequence))
+        else:
+            self.__pendingAcks.append((ticks_add(ticks_ms(), self.__ackDelay), sequence))
+
+        if radioData[1] == 50 or radioData[1] == 55: # the controller has answered a buzz, so stop repeating ours
+            self.__buzzRetryAt = None
+
+        if sequence in self.__recentSequences: # the controller didn't get our ack, so ack again without running the command twice
+            self.__duplicates += 1
+            return False
+        self.__recentSequences.append(sequence)
+        if len(self.__recentSequences) > RECENT_SEQUENCES:
+            self.__recentSequences.pop(0)
+        return True
+
+    def sendDueAcks(self):
+        now = ticks_ms()
+        for ack in self.__pendingAcks[:]:
+            if ticks_diff(now, ack[0]) >= 0:
+                radio.send_bytes(bytes([0, ACK_COMMAND, ack[1], self.__ID]))
+                self.__pendingAcks.remove(ack)
+
+    def sendPresence(self):
+        radio.send_bytes(bytes([0, PRESENCE_COMMAND, self.__ID, 255, STATE_CODES[self.__state], FIRMWARE_VERSION]))
+        self.__presenceDueAt = None
+
+    def buttonPressed(self):
+        # presses are edge triggered, so holding the button through an open doesn't buzz
+        # button A latches its presses between loops, the pin is sampled every loop and debounced on release
+        pressed = button_a.was_pressed()
+        if self.__buttonPin.read_digital():
+            if not self.__pinHeld and ticks_diff(ticks_ms(), self.__pinReleasedAt) >= DEBOUNCE:
+                pressed = True
+            self.__pinHeld = True
+        elif self.__pinHeld:
+            self.__pinHeld = False
+            self.__pinReleasedAt = ticks_ms()
+        return pressed
+
+    def sendDiagnostic(self):
+        pressToSend = min(self.__pressToSend, 0xFFFF)
+        maxLoop = min(self.__maxLoop, 0xFFFF)
+        duplicates = min(self.__duplicates, 0xFFFF)
+        radio.send_bytes(bytes([0, DIAGNOSTIC_REPORT, self.__ID, pressToSend & 0xFF, pressToSend >> 8, maxLoop & 0xFF, maxLoop >> 8, duplicates & 0xFF, duplicates >> 8]))
+        self.__diagnosticDueAt = None
+        self.__maxLoop = 0
+
+    def sendBuzz(self):
+        radio.send_bytes(self.__buzzPacket) # broadcast event to controller and other buzzers (to tell them to deactive)
+        self.__buzzAttempts += 1
+        self.__buzzRetryAt = ticks_add(ticks_ms(), BUZZ_RETRY_INTERVAL)
+
     def close(self):
         self.__state = "inactive"
         self.updatePixels()
@@ -61,14 +248,12 @@ class HostBuzzer:
         # get the correct color from ColorProfile object, and make the neopixels display it
         if self.__displayPixels:
             color = self.__colorProfile.get(self.__state)
-            self.displayColor(color)
+            self.__pixels.set(color, STATE_EFFECTS.get(self.__state))
         else:
             self.displayColor(BLACK)
 
     def displayColor(self, color):
-        for i in range(self.__pixelCount):
-            self.__pixels[i] = color
-        self.__pixels.show() # type: ignore
+        self.__pixels.set(color)
 
     def toggleLight(self, state=None):
         if state is not None:
@@ -84,18 +269,48 @@ class HostBuzzer:
 
     def mainloop(self):
         while True:
-            if (button_a.is_pressed() or self.__buttonPin.read_digital()) and self.__state == "waiting": # if the button is pressed and the state is waiting, the buzzer has been pressed and should activate
+            loopStart = ticks_us()
+            if self.__loopStart is not None:
+                self.__maxLoop = max(self.__maxLoop, ticks_diff(loopStart, self.__loopStart))
+            self.__loopStart = loopStart
+
+            if self.buttonPressed() and self.__state == "waiting": # if the button is pressed and the state is waiting, the buzzer has been pressed and should activate
+                # include ms since opening, so the controller can rank close presses
+                elapsed = min(max(ticks_diff(ticks_ms(), self.__openedAt), 0), 0xFFFF) if self.__openedAt is not None else 0xFFFF
+                self.__buzzPacket = bytes([0, 50, self.__ID, elapsed & 0xFF, elapsed >> 8])
+                self.__buzzAttempts = 0
+                self.sendBuzz() # sent before the neopixels are updated, as pushing them takes time
+                self.__pressToSend = ticks_diff(ticks_us(), loopStart)
+
                 self.setActive()
-                
-                for i in range(3):
-                    radio.send_bytes(bytes([50, self.__ID])) # broadcast event to controller and other buzzers (to tell them to deactive)
-                    sleep_ms(10)
+
+            # repeat the buzz until the controller answers it, or the buzzer is no longer active
+            if self.__buzzRetryAt is not None and ticks_diff(ticks_ms(), self.__buzzRetryAt) >= 0:
+                if self.__state == "active" and self.__buzzAttempts < MAX_BUZZ_ATTEMPTS:
+                    self.sendBuzz()
+                else:
+                    self.__buzzRetryAt = None
+
+            self.sendDueAcks()
+            if self.__pendingGroup is not None and len(self.__pendingAcks) == 0:
+                radio.config(group=self.__pendingGroup)
+                self.saveGroup(self.__pendingGroup)
+                self.__pendingGroup = None
+
+            if self.__presenceDueAt is not None and ticks_diff(ticks_ms(), self.__presenceDueAt) >= 0:
+                self.sendPresence()
+            if self.__diagnosticDueAt is not None and ticks_diff(ticks_ms(), self.__diagnosticDueAt) >= 0:
+                self.sendDiagnostic()
+
+            self.__pixels.update()
                     
             radioData = radio.receive_bytes()
-            if not radioData:
+            if not radioData or not self.receivePacket(radioData):
                 continue
+            radioData = radioData[1:] # drop the sequence number
 
             if radioData[0] == 10 or radioData[0] == 25 or radioData[0] == 30 or radioData[0] == 35:
+                self.__openedAt = ticks_add(ticks_ms(), -radioData[-1]) # the last byte is how long the controller had been sending this open
                 self.open()
             elif radioData[0] == 15 or radioData[0] == 20:
                 self.close()
@@ -114,7 +329,12 @@ class HostBuzzer:
             elif radioData[0] == 70: # set whether the neopixels should display or not
                 self.toggleLight(radioData[1])
             elif radioData[0] == 45: # update the neopixels, if an error occured
+                self.__pixels.redraw()
                 self.updatePixels()
+            elif radioData[0] == GROUP_COMMAND: # move to a new radio group, along with the controller
+                self.__pendingGroup = radioData[1]
+            elif radioData[0] == DIAGNOSTIC_COMMAND: # report button timings in this buzzer's slot, after the ack
+                self.__diagnosticDueAt = ticks_add(ticks_ms(), self.__ackDelay)
 
 buzzer = HostBuzzer(pin1, pin0, 7) # setup buzzer object
 
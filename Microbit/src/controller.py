@@ -1,81 +1,618 @@
 from microbit import uart, button_a #type: ignore
 import radio #type: ignore
+import random
 import time
 
+RADIO_GROUP = 16 #GROUP# set by compiler.py when flashing
+
+FRAME_SYNC = 0xFE
+MAX_PAYLOAD = 60
+RX_BUFFER_SIZE = 128 # bytes taken from the UART per loop, enough for two full frames
+
+BAUD_RATES = (9600, 19200, 38400, 57600, 115200, 230400)
+DEFAULT_BAUD_RATE = 9600
+BAUD_REVERT_TIME = 1000 # ms to wait for a valid frame at a new rate before falling back to the default
+MAX_BAD_BYTES = 32 # garbage bytes tolerated at a negotiated rate before assuming the host has fallen back
+
+# Radio packets from the controller are [sequence, command, args...], with sequences cycling 1-255
+# Buzzers acknowledge with [0, 95, sequence, ID], and packets from buzzers always use sequence 0
+ACK_COMMAND = 95
+ADDRESSED_COMMANDS = (55, 60, 80, 150) # only the buzzer named in the first argument acts on these, so only it acks
+ROSTER_COMMAND = 110 # [110, team ID for pin 0, ..., team ID for pin 24], 255 for buzzers not in the setup
+ROSTER_SIZE = 25
+NO_TEAM = 255
+GROUP_COMMAND = 115 # [115, group], buzzers switch radio group once they've acked it
+ORDERED_COMMANDS = (20, 60, ROSTER_COMMAND, GROUP_COMMAND) # later messages wait until these are acked, e.g. a colour profile needs the team, an open mustn't be closed by a late reset
+DIAGNOSTIC_REPORT = 125 # [0, 125, ID, press to send us, longest loop us, duplicates], 2 bytes each, the reply to 120
+REBOOT_COMMAND = 130 # [0, 130, ID, team ID (255 for none), firmware version], sent by a buzzer after it restarts
+STATE_COMMANDS = (10, 15, 25, 30, 35, 50, 75, 85, 90) # sending one of these makes retransmitting an older one pointless
+OPEN_COMMANDS = (10, 25, 30, 35)
+OPEN_ARGUMENTS = {10: 0, 25: 1, 30: 1, 35: 1} # arguments before an open's optional lockout ms and timeout ms, 2 bytes each
+LOCK_BYTES = 4 # opens are relayed as [open, args..., lock bitmap (4 bytes), lockout ms (2 bytes)]
+SURVEY_PING = 135 # [0, 135, survey ID, ping number], unacked, buzzers count them
+SURVEY_REPORT_REQUEST = 140 # [0, 140, survey ID], sent after the pings, each buzzer replies in its ack slot
+SURVEY_REPORT = 145 # [0, 145, ID, survey ID, pings received, -average RSSI, -weakest RSSI]
+SURVEY_PING_INTERVAL = 10 # ms
+SURVEY_REPORT_REQUESTS = 3 # a buzzer whose report is lost gets asked again
+FALSE_START_COMMAND = 150 # [0, 150, ID, ms since open (2 bytes)], repeated until answered with [150, ID]
+SEND_INTERVAL = 3 # ms between radio transmissions, so the buzzers' receive queues don't overflow
+ACK_SLOT = 2 # ms per buzzer in the ack window of a broadcast, each buzzer acks in the slot for its ID
+ACK_SLOTS = 26 # pin indexes 0-24, then one slot for the host buzzer
+ADDRESSED_ACK_TIMEOUT = 15 # ms
+ACK_MARGIN = 10 # ms added to every ack window for the radio and the buzzers' loops
+MAX_ATTEMPTS = 3
+
+ARBITRATION_WINDOW = 30 # ms after the first buzz to wait for others, then rank by press time
+NO_TIMESTAMP = 0xFFFF # buzzes without a timestamp rank after every timed one
+
+HEARTBEAT_COMMAND = 100 # [0, 100], unsequenced as no ack is needed
+PRESENCE_COMMAND = 105 # [0, 105, ID, team ID (255 for none), state, firmware version, locked], each buzzer's reply to a heartbeat
+HEARTBEAT_INTERVAL = 1000 # ms
+MISSED_HEARTBEATS = 3 # replies a buzzer can miss before broadcasts stop waiting for its acks
+
+class RadioMessage:
+    def __init__(self, sequence, command, pending):
+        self.sequence = sequence
+        self.command = command
+        self.pending = pending # IDs of the buzzers that haven't acked yet
+        self.attempts = 0
+        self.deadline = None
+        self.firstSent = None
+
+        # a newer message with the same key replaces this one, even if it hasn't finished being delivered
+        if command[0] in STATE_COMMANDS:
+            self.key = "state"
+        elif command[0] == 40 or command[0] == 20: # a later command doesn't redo a toggle or clear a lock, so never replace one
+            self.key = (command[0], sequence)
+        elif len(command) > 1 and command[0] != ROSTER_COMMAND:
+            self.key = (command[0], command[1])
+        else:
+            self.key = (command[0], None)
+
 class BuzzerController:
     def __init__(self):
-        uart.init(baudrate=9600)
+        self.__baudRate = DEFAULT_BAUD_RATE
+        self.__pendingBaudRate = None
+        self.__baudDeadline = None
+        self.__badBytes = 0
+        uart.init(baudrate=self.__baudRate)
 
         # setup the radio module
-        radio.config(group=16, power=7)
+        radio.config(group=RADIO_GROUP, power=7, queue=10, length=64) # acks arrive together, and the roster needs a longer packet
         radio.on()
 
+        self.__timeline = False # print an "ev" line for every radio packet and host frame handled
+        self.__radioSequence = random.randint(0, 254) # a random start, so buzzers don't drop the first messages after a restart as repeats of old ones
+        self.__pendingGroup = None
+        self.__outbox = []
+        self.__nextSendAt = time.ticks_ms()
+        self.__knownBuzzers = [] # every buzzer heard from, and so expected to ack broadcasts
+        self.__retransmits = {}
+        self.__lastHeard = {}
+
+        self.__heartbeatInterval = HEARTBEAT_INTERVAL
+        self.__nextHeartbeat = time.ticks_ms()
+
         self.__waitingForBuzz = False
         self.__activeID = None
+        self.__arbitrationWindow = ARBITRATION_WINDOW
+        self.__buzzDeadline = None
+        self.__buzzes = {}
+        self.__rejected = []
+        self.__falseStarts = [] # buzzers whose false start has been reported since the latest open
+        self.__answerTimeout = 0 # ms, from the latest open
+        self.__answerDeadline = None
+
+        # the whole lock set goes out with every open, and sets every buzzer's lock, so one that missed a lock or reset still gets it
+        self.__lockedBuzzers = 0 # bit n set if pin index n is locked
+        self.__teams = bytearray([NO_TEAM] * ROSTER_SIZE) # team ID for every pin index, from the roster and team assignments
+        # after a restart both are relearnt from presence replies, until the host's first reset or roster replaces them
+        self.__locksKnown = False
+        self.__teamsKnown = False
+
+        self.__surveyID = 0
+        self.__surveyPings = 0
+        self.__surveySent = 0
+        self.__surveyRequestsLeft = 0
+        self.__surveyNextAt = None
+        self.__surveyReported = [] # buzzers whose report for the current survey has been passed on
         
-        self.__lastCommand = ""
+        self.__lastCommand = None
+
+        # frame receive state: 0 = waiting for sync, 1 = length, 2 = sequence, 3 = payload, 4 = checksum
+        self.__rxState = 0
+        self.__rxLength = 0
+        self.__rxSequence = 0
+        self.__rxCount = 0
+        self.__lastSequence = None
+
+        # buffers are allocated once, so receiving a frame doesn't churn the heap
+        self.__rxBuffer = bytearray(RX_BUFFER_SIZE)
+        self.__rxView = memoryview(self.__rxBuffer)
+        self.__rxPayload = bytearray(MAX_PAYLOAD)
+
+        self.__loopCount = 0
+        self.__loopTotal = 0
+        self.__loopMax = 0
+
+    def event(self, *fields):
+        # "ev <ticks_ms> <event> <fields...>", for the host's timeline file
+        if self.__timeline:
+            print("ev", time.ticks_ms(), *fields)
 
     def sendMsg(self, array):
+        # queued, then sent and retransmitted until every buzzer acks
         try:
-            for i in range(3):
-                radio.send_bytes(bytes(array))
-                time.sleep_ms(10)
+            command = bytes(array)
         except ValueError:
             print("ERROR: Byte value out of range.")
+            return
+
+        self.__radioSequence = self.__radioSequence % 255 + 1
+        if command[0] in ADDRESSED_COMMANDS:
+            pending = [command[1]] if len(command) > 1 else []
+        else:
+            pending = list(self.__knownBuzzers)
+
+        message = RadioMessage(self.__radioSequence, command, pending)
+        for queued in self.__outbox:
+            if queued.key == message.key:
+                self.event("replaced", queued.sequence, message.sequence)
+        self.__outbox = [queued for queued in self.__outbox if queued.key != message.key]
+        self.__outbox.append(message)
+
+    def serviceOutbox(self):
+        now = time.ticks_ms()
+        if time.ticks_diff(now, self.__nextSendAt) < 0:
+            return
+
+        # the oldest message that is waiting to be sent, or whose ack window has closed
+        for message in self.__outbox:
+            if message.deadline is None or time.ticks_diff(now, message.deadline) >= 0:
+                break
+            if message.command[0] in ORDERED_COMMANDS: # anything queued after these must wait, e.g. to go out on the new group
+                return
+        else:
+            return
+
+        if message.deadline is not None:
+            if message.attempts >= MAX_ATTEMPTS:
+                for buzzerID in message.pending:
+                    print("noack", buzzerID)
+                self.event("giveup", message.sequence)
+                self.__outbox.remove(message)
+                return
+
+            for buzzerID in message.pending:
+                self.__retransmits[buzzerID] = self.__retransmits.get(buzzerID, 0) + 1
+
+        self.transmit(message, now)
+
+    def transmit(self, message, now):
+        if message.firstSent is None:
+            message.firstSent = now
+
+        packet = bytes([message.sequence]) + message.command
+        if message.command[0] in OPEN_COMMANDS: # ms since the first attempt, so buzzers can time presses from when the open was first sent
+            packet += bytes([min(time.ticks_diff(now, message.firstSent), 255)])
+        radio.send_bytes(packet)
+
+        message.attempts += 1
+        self.event("tx", message.sequence, message.attempts, *message.command[:2])
+        self.__nextSendAt = time.ticks_add(now, SEND_INTERVAL)
+        if message.command[0] in ADDRESSED_COMMANDS:
+            message.deadline = time.ticks_add(now, ADDRESSED_ACK_TIMEOUT)
+        elif len(message.pending) > 0:
+            message.deadline = time.ticks_add(now, ACK_SLOT * (max(self.ackSlot(buzzerID) for buzzerID in message.pending) + 1) + ACK_MARGIN)
+
+        if len(message.pending) == 0: # nobody is expected to ack, so there's nothing to wait for
+            self.__outbox.remove(message)
+
+    @staticmethod
+    def ackSlot(buzzerID):
+        return min(buzzerID, ACK_SLOTS - 1)
+
+    def receiveAck(self, sequence, buzzerID):
+        self.event("ack", sequence, buzzerID)
+        self.heardFrom(buzzerID)
+        for message in self.__outbox:
+            if message.sequence == sequence and buzzerID in message.pending:
+                message.pending.remove(buzzerID)
+                if len(message.pending) == 0:
+                    self.__outbox.remove(message)
+                return
+
+    def heardFrom(self, buzzerID):
+        self.__lastHeard[buzzerID] = time.ticks_ms()
+        if buzzerID not in self.__knownBuzzers:
+            self.__knownBuzzers.append(buzzerID)
+
+    def sendHeartbeat(self, now):
+        # forget buzzers that have stopped replying, so broadcasts don't keep retransmitting to them
+        for buzzerID in self.__knownBuzzers[:]:
+            if time.ticks_diff(now, self.__lastHeard[buzzerID]) > self.__heartbeatInterval * MISSED_HEARTBEATS:
+                self.__knownBuzzers.remove(buzzerID)
+
+        radio.send_bytes(bytes([0, HEARTBEAT_COMMAND]))
+        self.__nextSendAt = time.ticks_add(now, SEND_INTERVAL)
+        self.__nextHeartbeat = time.ticks_add(now, self.__heartbeatInterval)
+
+    def receivePresence(self, radioData):
+        # "presence <ID> <team ID> <state> <firmware version>", passed on for the host's roster
+        self.heardFrom(radioData[2])
+        if radioData[2] < ROSTER_SIZE:
+            if not self.__teamsKnown:
+                self.__teams[radioData[2]] = radioData[3]
+            if not self.__locksKnown and len(radioData) >= 7 and radioData[6] == 1:
+                self.lockBuzzer(radioData[2])
+        print("presence", radioData[2], radioData[3], radioData[4], radioData[5])
+
+    def receiveDiagnostic(self, radioData):
+        # "diag <ID> <press to send us> <longest loop us> <duplicates>"
+        self.heardFrom(radioData[2])
+        print("diag", radioData[2], radioData[3] | (radioData[4] << 8), radioData[5] | (radioData[6] << 8), radioData[7] | (radioData[8] << 8))
+
+    def receiveFalseStart(self, radioData):
+        # "falsestart <ID> <ms from opening>", the buzzer has already locked itself
+        elapsed = radioData[3] | (radioData[4] << 8)
+        self.heardFrom(radioData[2])
+        self.lockBuzzer(radioData[2])
+        self.sendMsg([FALSE_START_COMMAND, radioData[2]]) # answered every time, in case the last answer was lost
+        if radioData[2] in self.__falseStarts: # a repeat
+            return
+        self.__falseStarts.append(radioData[2])
+        self.event("falsestart", radioData[2], elapsed)
+        print("falsestart", radioData[2], elapsed)
+
+    def startSurvey(self, pings):
+        self.__surveyID = self.__surveyID % 255 + 1
+        self.__surveyPings = pings
+        self.__surveySent = 0
+        self.__surveyRequestsLeft = SURVEY_REPORT_REQUESTS
+        self.__surveyNextAt = time.ticks_ms()
+        self.__surveyReported = []
+        self.event("survey", self.__surveyID, pings)
+
+    def serviceSurvey(self, now):
+        if self.__surveySent < self.__surveyPings:
+            radio.send_bytes(bytes([0, SURVEY_PING, self.__surveyID, self.__surveySent]))
+            self.__surveySent += 1
+            self.__surveyNextAt = time.ticks_add(now, SURVEY_PING_INTERVAL)
+        elif self.__surveyRequestsLeft > 0:
+            radio.send_bytes(bytes([0, SURVEY_REPORT_REQUEST, self.__surveyID]))
+            self.__surveyRequestsLeft -= 1
+            self.__surveyNextAt = time.ticks_add(now, ACK_SLOT * ACK_SLOTS + ACK_MARGIN) # every buzzer's slot has passed
+        else:
+            print("survey done", self.__surveyPings)
+            self.__surveyNextAt = None
+        self.__nextSendAt = time.ticks_add(now, SEND_INTERVAL)
+
+    def receiveSurveyReport(self, radioData):
+        # "survey <ID> <sent> <received> <average RSSI> <weakest RSSI>", once per buzzer
+        self.heardFrom(radioData[2])
+        if radioData[3] != self.__surveyID or radioData[2] in self.__surveyReported:
+            return
+        self.__surveyReported.append(radioData[2])
+        print("survey", radioData[2], self.__surveyPings, radioData[4], -radioData[5], -radioData[6])
+
+    def receiveReboot(self, radioData):
+        # "reboot <ID> <team ID>", so the host can resend that buzzer's configuration
+        self.heardFrom(radioData[2])
+        self.event("reboot", radioData[2])
+        print("reboot", radioData[2], radioData[3])
+
+    def reportRetransmits(self):
+        # "retransmits <ID>:<count> ...", counted since the controller started
+        print("retransmits " + " ".join(str(buzzerID) + ":" + str(count) for buzzerID, count in sorted(self.__retransmits.items())))
 
     def mainloop(self):
-        serialData = ""
         while True:
-            # check radio data for buzz
-            radioData = radio.receive_bytes()
-            if radioData:
-                if int(radioData[0]) == 50:
-                    if self.__waitingForBuzz:
-                        if self.__activeID is None:
-                            self.__waitingForBuzz = False
-                            self.__activeID = int(radioData[1])
-                            print("buzzed", str(radioData[1]))
-                            
-                            self.sendMsg([50, int(radioData[1])])
-                        elif self.__activeID != int(radioData[1]):
-                            self.sendMsg([55, int(radioData[1])])
-
-            #! check for MACROS
-            if button_a.is_pressed():
-                if self.__lastCommand != "":
-                    self.execute(self.__lastCommand)
-                    time.sleep(0.1)
-
-            # check serial data for command
-            newByte = uart.read(1)
-            if newByte is None:
-                continue
+            start = time.ticks_us()
+            self.poll()
+            self.recordLoopTime(time.ticks_diff(time.ticks_us(), start))
 
-            newChar = str(newByte, "utf-8")
-            if newChar == "\n":
-                self.__lastCommand = serialData
-                self.execute(serialData)
-                serialData = ""
+    def poll(self):
+        # check radio data for buzzes and acks, which buzzers send unsequenced
+        radioData = radio.receive_bytes()
+        if radioData and radioData[0] == 0 and len(radioData) >= 3:
+            if radioData[1] == 50:
+                self.receiveBuzz(radioData[1:])
+            elif radioData[1] == ACK_COMMAND and len(radioData) >= 4:
+                self.receiveAck(radioData[2], radioData[3])
+            elif radioData[1] == PRESENCE_COMMAND and len(radioData) >= 6:
+                self.receivePresence(radioData)
+            elif radioData[1] == DIAGNOSTIC_REPORT and len(radioData) >= 9:
+                self.receiveDiagnostic(radioData)
+            elif radioData[1] == REBOOT_COMMAND and len(radioData) >= 5:
+                self.receiveReboot(radioData)
+            elif radioData[1] == FALSE_START_COMMAND and len(radioData) >= 5:
+                self.receiveFalseStart(radioData)
+            elif radioData[1] == SURVEY_REPORT and len(radioData) >= 7:
+                self.receiveSurveyReport(radioData)
+
+        now = time.ticks_ms()
+        if self.__heartbeatInterval > 0 and time.ticks_diff(now, self.__nextHeartbeat) >= 0 and time.ticks_diff(now, self.__nextSendAt) >= 0:
+            self.sendHeartbeat(now)
+
+        if self.__surveyNextAt is not None and time.ticks_diff(now, self.__surveyNextAt) >= 0 and time.ticks_diff(now, self.__nextSendAt) >= 0:
+            self.serviceSurvey(now)
+
+        # switch group once the change is acked or given up on, before the outbox sends anything else
+        if self.__pendingGroup is not None and not any(message.command[0] == GROUP_COMMAND for message in self.__outbox):
+            radio.config(group=self.__pendingGroup)
+            print("group", self.__pendingGroup)
+            self.__pendingGroup = None
+
+        self.serviceOutbox()
+
+        # once the window after the first buzz has passed, pick the earliest press
+        if self.__buzzDeadline is not None and time.ticks_diff(time.ticks_ms(), self.__buzzDeadline) >= 0:
+            self.resolveBuzzes()
+
+        # close everything if nobody has buzzed by the end of the answer window
+        if self.__answerDeadline is not None and self.__buzzDeadline is None and time.ticks_diff(time.ticks_ms(), self.__answerDeadline) >= 0:
+            self.answerTimedOut()
+
+        # fall back to the default rate if the host never confirmed the new one
+        if self.__baudDeadline is not None and time.ticks_diff(time.ticks_ms(), self.__baudDeadline) > 0:
+            self.setBaudRate(DEFAULT_BAUD_RATE)
+
+        #! check for MACROS
+        if button_a.is_pressed():
+            if self.__lastCommand is not None:
+                self.execute(self.__lastCommand)
+                time.sleep(0.1)
+
+        # check serial data for commands, reading everything waiting at once
+        if uart.any():
+            count = uart.readinto(self.__rxBuffer)
+            if count:
+                self.receiveBytes(count)
+
+    def recordLoopTime(self, elapsed):
+        self.__loopCount += 1
+        self.__loopTotal += elapsed
+        if elapsed > self.__loopMax:
+            self.__loopMax = elapsed
+
+    def reportLoopTime(self):
+        # "loop <iterations> <average us> <max us>", then start a new measurement
+        if self.__loopCount > 0:
+            print("loop", self.__loopCount, self.__loopTotal // self.__loopCount, self.__loopMax)
+        self.__loopCount = 0
+        self.__loopTotal = 0
+        self.__loopMax = 0
+
+    def receiveBuzz(self, radioData):
+        buzzerID = int(radioData[1])
+        self.heardFrom(buzzerID)
+        if len(radioData) >= 4: # ms from the buzzer opening to it being pressed
+            elapsed = radioData[2] | (radioData[3] << 8)
+        else:
+            elapsed = NO_TIMESTAMP
+        self.event("buzz", buzzerID, elapsed)
+
+        if self.__waitingForBuzz:
+            if self.__buzzDeadline is None:
+                self.__buzzDeadline = time.ticks_add(time.ticks_ms(), self.__arbitrationWindow)
+            if buzzerID not in self.__buzzes or elapsed < self.__buzzes[buzzerID]:
+                self.__buzzes[buzzerID] = elapsed
             else:
-                serialData += newChar
-
-    def execute(self, serialData):
-        #print(serialData)
-        commands = serialData.split(";")
-        for command in commands:
-            try:
-                commandArray = list(map(int, command.split()))
-            except ValueError:
-                print("ERROR: Non integer value in command string.")
+                self.event("dup", buzzerID)
+        elif self.__activeID is not None and self.__activeID != buzzerID and buzzerID not in self.__rejected:
+            self.__rejected.append(buzzerID)
+            self.sendMsg([55, buzzerID])
+        else: # a repeat of a buzz that has already been answered, or one that arrived while closed
+            self.event("dup", buzzerID)
+
+    def answerTimedOut(self):
+        self.__answerDeadline = None
+        self.__waitingForBuzz = False
+        self.__buzzes = {}
+        self.sendMsg([15])
+        self.event("timeout")
+        print("timeout")
+
+    def resolveBuzzes(self):
+        ranking = sorted(self.__buzzes.items(), key=lambda buzz: buzz[1])
+        self.__buzzDeadline = None
+        self.__buzzes = {}
+        self.__waitingForBuzz = False
+        self.__answerDeadline = None
+        self.__activeID = ranking[0][0]
+        self.event("resolve", self.__activeID)
+
+        # report every press in the window with its delay behind the winner, e.g. "buzzed 3 +0 7 +12"
+        print("buzzed " + " ".join(str(buzzerID) + " +" + str(elapsed - ranking[0][1]) for buzzerID, elapsed in ranking))
+
+        self.sendMsg([50, self.__activeID])
+        for buzzerID, elapsed in ranking[1:]: # buzzers that also lit up need telling they lost
+            self.__rejected.append(buzzerID)
+            self.sendMsg([55, buzzerID])
+
+    def setBaudRate(self, rate):
+        time.sleep_ms(10) # let any queued output finish at the old rate
+        self.__baudRate = rate
+        self.__badBytes = 0
+        if rate == DEFAULT_BAUD_RATE:
+            self.__baudDeadline = None
+        else:
+            self.__baudDeadline = time.ticks_add(time.ticks_ms(), BAUD_REVERT_TIME)
+        uart.init(baudrate=rate)
+
+    def badByte(self):
+        self.__badBytes += 1
+        if self.__baudRate != DEFAULT_BAUD_RATE and self.__badBytes > MAX_BAD_BYTES:
+            self.setBaudRate(DEFAULT_BAUD_RATE)
+
+    def receiveBytes(self, count):
+        i = 0
+        while i < count:
+            if self.__rxState == 3:
+                # copy as much of the payload as has arrived in one slice, rather than a byte at a time
+                take = min(self.__rxLength - self.__rxCount, count - i)
+                self.__rxPayload[self.__rxCount:self.__rxCount + take] = self.__rxView[i:i + take]
+                self.__rxCount += take
+                i += take
+                if self.__rxCount == self.__rxLength:
+                    self.__rxState = 4
+            else:
+                self.receiveByte(self.__rxBuffer[i])
+                i += 1
+
+    def receiveByte(self, value):
+        if self.__rxState == 0:
+            if value == FRAME_SYNC:
+                self.__rxState = 1
+            else:
+                self.badByte()
+        elif self.__rxState == 1:
+            if 0 < value <= MAX_PAYLOAD:
+                self.__rxLength = value
+                self.__rxCount = 0
+                self.__rxState = 2
+            else:
+                self.__rxState = 0
+        elif self.__rxState == 2:
+            self.__rxSequence = value
+            self.__rxState = 3
+        else:
+            self.__rxState = 0
+            payload = self.__rxPayload[:self.__rxLength]
+            if value != (self.__rxLength + self.__rxSequence + sum(payload)) & 0xFF:
+                self.badByte()
+                print("nak", self.__rxSequence)
+                return
+
+            # any valid frame confirms the current baud rate
+            self.__badBytes = 0
+            self.__baudDeadline = None
+
+            # a restarted host begins with a baud change or ping, which always run and end any dedup against the old host's sequence
+            commands = self.decodeFrame(payload)
+            if commands is not None and commands[0][0] in (200, 201):
+                self.__lastSequence = None
+
+            # a repeated sequence means our ack was lost, so ack without re-running
+            if self.__rxSequence != self.__lastSequence:
+                self.event("frame", self.__rxSequence)
+                self.__lastSequence = self.__rxSequence
+                if commands is not None:
+                    self.execute(commands)
+                    if commands[0][0] < 200: # don't replay controller-only commands from the macro button
+                        self.__lastCommand = commands
+            else:
+                self.event("dupframe", self.__rxSequence)
+
+            print("ack", self.__rxSequence)
+
+            if self.__pendingBaudRate is not None:
+                self.setBaudRate(self.__pendingBaudRate)
+                self.__pendingBaudRate = None
+
+    def decodeFrame(self, payload):
+        # the payload is a run of commands, each prefixed with its length
+        commands = []
+        i = 0
+        while i < len(payload):
+            end = i + 1 + payload[i]
+            if payload[i] == 0 or end > len(payload):
+                print("ERROR: Malformed command in frame.")
+                return None
+            commands.append(payload[i + 1:end])
+            i = end
+        return commands
+
+    def executeLocal(self, commandArray):
+        if commandArray[0] == 200: # change baud rate, once the ack for this frame has gone out at the old rate
+            if len(commandArray) == 2 and commandArray[1] < len(BAUD_RATES):
+                self.__pendingBaudRate = BAUD_RATES[commandArray[1]]
+            else:
+                print("ERROR: Unsupported baud rate.")
+        elif commandArray[0] == 202: # set the buzz arbitration window in ms
+            if len(commandArray) == 2:
+                self.__arbitrationWindow = commandArray[1]
+        elif commandArray[0] == 203: # report loop timing since the last report
+            self.reportLoopTime()
+        elif commandArray[0] == 204: # report radio retransmits per buzzer
+            self.reportRetransmits()
+        elif commandArray[0] == 205: # set the heartbeat interval in tenths of a second, 0 turns heartbeats off
+            if len(commandArray) == 2:
+                self.__heartbeatInterval = commandArray[1] * 100
+                self.__nextHeartbeat = time.ticks_ms()
+        elif commandArray[0] == 206: # move every buzzer, then the controller, to a new radio group
+            if len(commandArray) == 2:
+                self.sendMsg([GROUP_COMMAND, commandArray[1]])
+                self.__pendingGroup = commandArray[1]
+        elif commandArray[0] == 207: # turn the event timeline on (1) or off (0)
+            if len(commandArray) == 2:
+                self.__timeline = commandArray[1] != 0
+                self.event("timeline")
+        elif commandArray[0] == 208: # survey the radio link with the given number of pings
+            if len(commandArray) == 2 and commandArray[1] > 0:
+                self.startSurvey(commandArray[1])
+        # 201 (ping) needs no action, the ack for its frame is the reply
+
+    def lockBuzzer(self, pinIndex):
+        if pinIndex is not None and pinIndex < ROSTER_SIZE:
+            self.__lockedBuzzers |= 1 << pinIndex
+
+    def updateLocks(self, commandArray):
+        # track the commands that change which buzzers are locked, or which team a buzzer belongs to
+        if commandArray[0] == 20:
+            self.__lockedBuzzers = 0
+            self.__locksKnown = True
+        elif commandArray[0] == 25 and len(commandArray) >= 2: # every buzzer in the team
+            for pinIndex in range(ROSTER_SIZE):
+                if self.__teams[pinIndex] == commandArray[1]:
+                    self.lockBuzzer(pinIndex)
+        elif commandArray[0] == 30 and len(commandArray) >= 2: # the named buzzer, or the one that won the last buzz if the host didn't know it
+            self.lockBuzzer(commandArray[1] if commandArray[1] < ROSTER_SIZE else self.__activeID)
+        elif commandArray[0] == ROSTER_COMMAND:
+            self.__teamsKnown = True
+            for pinIndex in range(min(ROSTER_SIZE, len(commandArray) - 1)):
+                self.__teams[pinIndex] = commandArray[pinIndex + 1]
+        elif commandArray[0] == 60 and len(commandArray) >= 3 and commandArray[1] < ROSTER_SIZE:
+            self.__teams[commandArray[1]] = commandArray[2]
+        elif commandArray[0] == 80 and len(commandArray) >= 2 and commandArray[1] < ROSTER_SIZE:
+            self.__teams[commandArray[1]] = NO_TEAM
+
+    def relayedOpen(self, commandArray):
+        # the timeout is kept here, the lock set and lockout (0 if unset) go to the buzzers
+        length = 1 + OPEN_ARGUMENTS[commandArray[0]]
+        lockout = 0
+        self.__answerTimeout = 0
+        if len(commandArray) >= length + 4:
+            lockout = commandArray[length] | (commandArray[length + 1] << 8)
+            self.__answerTimeout = commandArray[length + 2] | (commandArray[length + 3] << 8)
+        locks = bytes([(self.__lockedBuzzers >> (8 * i)) & 0xFF for i in range(LOCK_BYTES)])
+        return bytes(commandArray[:length]) + locks + bytes([lockout & 0xFF, lockout >> 8])
+
+    def execute(self, commands):
+        for commandArray in commands:
+            if commandArray[0] >= 200: # controller-only commands aren't relayed to the buzzers
+                self.executeLocal(commandArray)
                 continue
-            
-            self.sendMsg(commandArray)
 
-            if commandArray[0] == 10 or commandArray[0] == 25 or commandArray[0] == 30 or commandArray[0] == 35:
+            self.updateLocks(commandArray)
+            if commandArray[0] in OPEN_COMMANDS:
+                self.sendMsg(self.relayedOpen(commandArray))
+            else:
+                self.sendMsg(commandArray)
+
+            if commandArray[0] in OPEN_COMMANDS:
                 self.__waitingForBuzz = True
                 self.__activeID = None
-            elif commandArray[0] == 15 or commandArray[0] == 20 or commandArray[0] == 60 or commandArray[0] == 75 or commandArray[0] == 85 or commandArray[0] == 50:
+                self.__buzzDeadline = None
+                self.__buzzes = {}
+                self.__rejected = []
+                self.__falseStarts = []
+                self.__answerDeadline = time.ticks_add(time.ticks_ms(), self.__answerTimeout) if self.__answerTimeout > 0 else None
+            elif commandArray[0] == 15 or commandArray[0] == 20 or commandArray[0] == 60 or commandArray[0] == ROSTER_COMMAND or commandArray[0] == 75 or commandArray[0] == 85 or commandArray[0] == 50:
                 self.__waitingForBuzz = False
+                self.__buzzDeadline = None
+                self.__buzzes = {}
+                self.__answerDeadline = None
 
 controller = BuzzerController()
 controller.mainloop()
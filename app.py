@@ -1,19 +1,23 @@
 import eventlet.wsgi
 import pathlib
 import pygubu
-import serial
-import serial.tools.list_ports as list_ports
 import threading
+import queue
+import itertools
+from concurrent.futures import Future
 import sqlite3
 from pygame import mixer
-from customWidgets import TeamSetup, Selector, ConfigurationSetCreator, BigPicture, HostAidDisplay, HostScoreboard, Soundboard, MacroController, BigPictureConfigurationPanel, PopOutWidget, createPopOutBigPictureControl
+from commandProtocol import groupCommands, frameSize, ControllerCommandID, DEFAULT_RADIO_GROUP
+from serialController import SerialController
+from latencyMonitor import LatencyMonitor
+from eventTimeline import EventTimeline
+from customWidgets import TeamSetup, Selector, ConfigurationSetCreator, BigPicture, HostAidDisplay, HostScoreboard, Soundboard, MacroController, BigPictureConfigurationPanel, PopOutWidget, DiagnosticsPanel, RosterPanel, createPopOutBigPictureControl
 import customtkinter as ctk
-from os import path
-from tkinter import messagebox
+from os import path, getenv
+from tkinter import messagebox, filedialog
 import tkinter as tk
 import json
-from time import sleep
-import sys
+from time import perf_counter
 from PIL import ImageTk
 import socketio as sio
 import eventlet
@@ -42,6 +46,46 @@ class CommandID:
     NOT_NEEDED = 80
     IDENTIFY_TEAM = 85
     IDENTIFY_ALL = 90
+    ROSTER_ASSIGNMENT = 110
+    DIAGNOSTIC = 120
+
+    @staticmethod
+    def name(commands):
+        # the name of the first command in a list of command strings, used to group latency timings
+        data = commands[0].split() if commands else []
+        if len(data) == 0 or not data[0].isdigit():
+            return "UNKNOWN"
+
+        for name, value in vars(CommandID).items():
+            if value == int(data[0]) and not name.startswith("_"):
+                return name
+        return data[0]
+
+class CommandPriority:
+    URGENT = 0
+    NORMAL = 1
+    BULK = 2
+
+    # every command that sets buzzer states is urgent, so a later one can never overtake an earlier one and leave the buzzers in the wrong state
+    URGENT_COMMANDS = (CommandID.OPEN, CommandID.CLOSE, CommandID.RESET_LOCK, CommandID.OPEN_LOCK_TEAM, CommandID.OPEN_LOCK_IND, CommandID.OPEN_TEAM, CommandID.BUZZED, CommandID.IGNORE_BUZZ,
+                       CommandID.IDENTIFY, CommandID.IDENTIFY_TEAM, CommandID.IDENTIFY_ALL)
+    BULK_COMMANDS = (CommandID.TEAM_ASSIGNMENT, CommandID.COLOR_PROFILE_ASSIGNMENT, CommandID.ROSTER_ASSIGNMENT)
+
+    @staticmethod
+    def fromCommands(commands):
+        # a group of commands is sent at the priority of its most urgent member
+        priority = CommandPriority.BULK
+        for command in commands:
+            data = command.split()
+            if len(data) == 0 or not data[0].isdigit():
+                continue
+
+            commandID = int(data[0])
+            if commandID in CommandPriority.URGENT_COMMANDS:
+                return CommandPriority.URGENT
+            elif commandID not in CommandPriority.BULK_COMMANDS:
+                priority = CommandPriority.NORMAL
+        return priority
 
 class Sound:
     INCORRECT = mixer.Sound("assets/sounds/incorrect.mp3")
@@ -68,12 +112,49 @@ class Sound:
         "Drum Roll": DRUMROLL
     }
 
+class RadioSurvey:
+    PINGS = 100 # sent by the controller, at 10 ms apart
+
+    def __init__(self):
+        self.__results = {} # pin index -> (pings sent, pings received, average RSSI, weakest RSSI)
+        self.running = False
+
+    def start(self):
+        self.__results = {}
+        self.running = True
+
+    def update(self, pinIndex, sent, received, averageRssi, weakestRssi):
+        self.__results[pinIndex] = (sent, received, averageRssi, weakestRssi)
+
+    def finish(self):
+        self.running = False
+
+    def summary(self, expectedBuzzers):
+        # "ID:loss%/average dBm/weakest dBm", with buzzers in the setup that never reported shown as lost
+        if not self.__results and not self.running:
+            return "not run"
+
+        entries = []
+        for pinIndex in sorted(set(self.__results) | set(expectedBuzzers)):
+            if pinIndex in self.__results:
+                sent, received, averageRssi, weakestRssi = self.__results[pinIndex]
+                loss = 100 * (sent - received) / sent if sent > 0 else 0
+                entries.append(f"{pinIndex}:{loss:.0f}%/{averageRssi}/{weakestRssi}")
+            elif not self.running:
+                entries.append(f"{pinIndex}:no reply")
+
+        return ("running " if self.running else "") + (" ".join(entries) or "no replies")
+
 class TeamController:
+    ROSTER_SIZE = 25 # one roster entry for every buzzer pin index
+    NO_TEAM = 255
+
     def __init__(self, questionController, updateScoresCallback):
         self.__questionController = questionController
         self.__updateScoresCallback = updateScoresCallback
 
         self.__teams = []
+        self.__radioGroup = DEFAULT_RADIO_GROUP
 
         self.__activeTeam = None
         self.__activeBuzzer = None
@@ -160,32 +241,37 @@ class TeamController:
                 return team.getBuzzer(self.__activeBuzzer).pinIndex
         return 255
 
-    def setupTeams(self, teams):
+    def setupTeams(self, teams, radioGroup=DEFAULT_RADIO_GROUP):
         self.__teams = []
-        commands = []
-
-        availableBuzzers = list(range(25))
+        self.__radioGroup = radioGroup
         for i, team in enumerate(teams):
-            newTeam = Team(i, team[0], team[1], team[2])
-            commands.extend(newTeam.generateCommands())
-            
-            for buzzerID in team[2]: 
-                if buzzerID in availableBuzzers:
-                    availableBuzzers.remove(buzzerID)
+            self.__teams.append(Team(i, team[0], team[1], team[2]))
 
-            self.__teams.append(newTeam)
-            
-        notNeededFirst = [f"{CommandID.NOT_NEEDED} {buzzerID}" for buzzerID in availableBuzzers]
-        notNeededFirst.extend(commands)
-
-        return commands
+        return self.getCommands()
 
     def getCommands(self):
-        commands = []
+        # the group goes first, so a controller that has restarted on its flashed group brings the buzzers back to this one
+        # the roster follows, as buzzers only accept the colour profile for the team they've been assigned
+        commands = [f"{ControllerCommandID.SET_RADIO_GROUP} {self.__radioGroup}", self.generateRosterCommand()]
         for team in self.__teams:
             commands.extend(team.generateCommands())
         return commands
 
+    def generateRosterCommand(self):
+        # the team ID for every pin index in one command, buzzers left out of the setup get NO_TEAM and act as NOT_NEEDED
+        roster = [self.NO_TEAM] * self.ROSTER_SIZE
+        for team in self.__teams:
+            for buzzer in team.buzzers:
+                roster[buzzer.pinIndex] = team.teamID
+        return f"{CommandID.ROSTER_ASSIGNMENT} " + " ".join(str(teamID) for teamID in roster)
+
+    def getBuzzerCommands(self, pinIndex):
+        # resends a single buzzer's team and colour profile, for a buzzer that reports it has restarted
+        for team in self.__teams:
+            if team.fromPinIndex(pinIndex) is not None:
+                return [f"{CommandID.TEAM_ASSIGNMENT} {pinIndex} {team.teamID}"] + team.generateCommands()
+        return [f"{CommandID.NOT_NEEDED} {pinIndex}"]
+
     def getTeamStrings(self):
         strings = []
         for team in self.__teams:
@@ -199,6 +285,14 @@ class TeamController:
                 return team.teamID, buzzerID
         return 0, 0
 
+    def getExpectedBuzzers(self):
+        # pin index -> (team ID, "team - buzzer" alias) for every buzzer in the current team setup
+        expected = {}
+        for team in self.__teams:
+            for buzzer in team.buzzers:
+                expected[buzzer.pinIndex] = (team.teamID, f"{team.alias} - {buzzer.alias}")
+        return expected
+
     @property
     def activeTeam(self):
         return self.__activeTeam
@@ -239,11 +333,13 @@ class Team:
     def activeColor(self):
         return self.__activeTextCol
 
+    @property
+    def buzzers(self):
+        return self.__buzzers
+
     def generateCommands(self):
+        # team assignment is sent for every team at once, by TeamController.generateRosterCommand
         commands = []
-        for buzzer in self.__buzzers:
-            commands.append(
-                f"{CommandID.TEAM_ASSIGNMENT} {buzzer.pinIndex} {self.__ID}")
 
         colorCommand = f"{CommandID.COLOR_PROFILE_ASSIGNMENT} {self.__ID} "
         for color in self.__colorPalette[:-1]:
@@ -462,85 +558,6 @@ class AidController:
         if self.__bigPictureDisplay is not None and self.__bigPictureDisplay.winfo_exists():
             self.__bigPictureDisplay.seek(time)
 
-class SerialController(threading.Thread):
-    def __init__(self, readCallback):
-        super().__init__(daemon=True)
-        
-        self.attemptConnection()
-        
-        self.__readCallback = readCallback
-
-    def attemptConnection(self):
-        self.__port = self.findCOMport(516, 3368, 9600)
-        if not self.__port.is_open:
-            self.raiseException()
-
-    def findCOMport(self, PID, VID, baud):
-        serPort = serial.Serial(baudrate=baud)
-
-        ports = list(list_ports.comports())
-        for p in ports:
-            try:
-                if p.pid == PID and p.vid == VID:
-                    serPort.port = str(p.device)
-                    serPort.open()
-            except AttributeError:
-                continue
-
-        return serPort
-
-    def checkBuffer(self):
-        return self.__port.in_waiting > 0
-
-    def getLine(self):
-        return self.__port.readline().decode("utf-8")
-
-    def singleSend(self, string):
-        try:
-            self.__port.write(bytes((string + "\n"), "utf-8"))
-            return True
-        except Exception as e:
-            messagebox.showerror("Unexpected Error Occured", f"An error occured. Try restarting the application. {e}")
-            
-    def multiSend(self, commands):
-        commandString = ";".join(commands)
-        if len(commandString) > 50:              
-            separatedCommands = [commands[0]]
-            currentIndex = 0
-            for command in commands[1:]:
-                if len(separatedCommands[currentIndex]) + len(command) + 1 > 50:
-                    currentIndex += 1
-                    separatedCommands.append(command)
-                else:
-                    separatedCommands[currentIndex] += f";{command}"
-                    
-            for smallCommand in separatedCommands:
-                if not self.singleSend(smallCommand):
-                    break
-                sleep(0.5)
-        else:
-            self.singleSend(commandString)
-
-    def raiseException(self):
-        askRetry = messagebox.askretrycancel(
-            title = "Controller Connection Error",
-            message = "No controller micro:bit was detected. Retry?"
-        )
-        if askRetry:
-            self.attemptConnection()
-        else:
-            app.destroy()
-            sys.exit()
-
-    def run(self):
-        while True:
-            try:
-                if self.checkBuffer():
-                    data = self.getLine()
-                    self.__readCallback(data)
-            except:
-                self.raiseException()
-                
 class FarThrowServer(threading.Thread):
     def __init__(self, readCallback):
         super().__init__(daemon=True)
@@ -550,6 +567,7 @@ class FarThrowServer(threading.Thread):
         self.app = sio.WSGIApp(self.server)
         
         self.__readCallback = readCallback
+        self.lastWriteTime = None
         
         self.connectCallbacks()
         self.server.on("receive", self.receive)
@@ -565,12 +583,25 @@ class FarThrowServer(threading.Thread):
             
     def receive(self, sid, data):
         self.__readCallback(data)
+        
+    @property
+    def connected(self):
+        return True
+
+    def waitForConnection(self):
+        return
+
+    def prepareLink(self):
+        return
             
     def multiSend(self, commands):
         self.server.emit("multi", commands)
+        self.lastWriteTime = perf_counter()
+        return True
         
     def singleSend(self, command):
         self.server.emit("single", command)
+        return True
         
     def sendUpdate(self, updateData):
         self.server.emit("update", updateData)
@@ -590,28 +621,326 @@ class FarThrowServer(threading.Thread):
     def run(self):
         eventlet.wsgi.server(eventlet.listen(("", 8000)), self.app)
         
+class CommandCoalescer:
+    def __init__(self, window=0.005):
+        self.window = window # seconds to wait for further commands to merge with the first
+
+        self.commandsSaved = 0
+        self.bytesSaved = 0
+
+    @staticmethod
+    def commandID(command):
+        return int(command.split()[0])
+
+    @staticmethod
+    def coalesce(commands):
+        result = []
+        for command in commands:
+            commandID = CommandCoalescer.commandID(command)
+            lastID = CommandCoalescer.commandID(result[-1]) if result else None
+
+            if result and command == result[-1] and commandID != CommandID.LIGHT_TOGGLE:
+                continue # repeating a command straight away has no further effect, except for a toggle
+            if commandID == CommandID.CLOSE and lastID == CommandID.RESET_LOCK:
+                continue # resetting the lock already closes every buzzer
+            if lastID == CommandID.CLOSE and commandID in (CommandID.RESET_LOCK, CommandID.OPEN):
+                result.pop() # the new command sets the state the close would have
+
+            # a later light refresh makes an earlier one redundant, and setting the lights overrides any earlier light command
+            if commandID == CommandID.LIGHT_UPDATE:
+                result = [c for c in result if CommandCoalescer.commandID(c) != CommandID.LIGHT_UPDATE]
+            elif commandID == CommandID.LIGHT_SET:
+                result = [c for c in result if CommandCoalescer.commandID(c) not in (CommandID.LIGHT_UPDATE, CommandID.LIGHT_SET)]
+
+            result.append(command)
+        return result
+
+    def merge(self, commandLists):
+        commands = []
+        for commandList in commandLists:
+            commands.extend(commandList)
+
+        merged = self.coalesce(commands)
+        self.commandsSaved += len(commands) - len(merged)
+        self.bytesSaved += sum(frameSize(commandList) for commandList in commandLists) - frameSize(merged)
+        return merged
+
+class CommandBatch:
+    def __init__(self, commands, parts, callback=None, trace=None):
+        self.commands = commands
+        self.trace = trace
+        self.future = Future()
+        if callback is not None:
+            self.future.add_done_callback(callback)
+
+        self.__remaining = parts
+
+    def partSent(self, success, written=None):
+        if self.future.done():
+            return
+
+        self.__remaining -= 1
+        if not success:
+            self.future.set_result(False)
+        elif self.__remaining <= 0:
+            if self.trace is not None:
+                self.trace.mark("written", written)
+                self.trace.finish("acked")
+            self.future.set_result(True)
+
+class CommandQueue(threading.Thread):
+    def __init__(self, sender, errorCallback, coalescer=None):
+        super().__init__(daemon=True)
+
+        self.__sender = sender
+        self.__errorCallback = errorCallback
+        self.__coalescer = coalescer if coalescer is not None else CommandCoalescer()
+
+        self.__queue = queue.PriorityQueue()
+        self.__order = itertools.count() # keeps commands of equal priority in the order they were queued
+
+    def put(self, commands, callback=None, trace=None):
+        groups = groupCommands(commands)
+        batch = CommandBatch(commands, len(groups), callback, trace)
+        if len(groups) == 0:
+            batch.future.set_result(True)
+
+        # each frame-sized group is queued separately, so urgent commands from another sender can be sent between the frames of a bulk transfer
+        # every group shares the priority of the whole batch, so the batch's own commands are never reordered
+        priority = CommandPriority.fromCommands(commands)
+        for group in groups:
+            self.__queue.put((priority, next(self.__order), group, batch))
+
+        return batch.future
+
+    @property
+    def coalescer(self):
+        return self.__coalescer
+
+    def collect(self, job):
+        # gather jobs queued within a short window of the first, as long as their commands still fit in one frame
+        # an urgent job doesn't wait for the window, and only picks up jobs that are already queued
+        jobs = [job]
+        commands = list(job[2])
+        window = 0 if job[0] == CommandPriority.URGENT else self.__coalescer.window
+        deadline = perf_counter() + window
+        while True:
+            remaining = deadline - perf_counter()
+            try:
+                nextJob = self.__queue.get(timeout=remaining) if remaining > 0 else self.__queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if len(groupCommands(commands + nextJob[2])) > 1:
+                self.__queue.put(nextJob)
+                break
+
+            jobs.append(nextJob)
+            commands.extend(nextJob[2])
+
+        jobs.sort(key=lambda job: job[1]) # merge in the order the commands were issued, not by priority
+        return jobs
+
+    def send(self, jobs):
+        jobs = [job for job in jobs if not job[3].future.done()] # an earlier part of the batch failed, so don't send the rest
+        if len(jobs) == 0:
+            return True
+
+        commands = self.__coalescer.merge([job[2] for job in jobs])
+
+        self.__sender.prepareLink()
+        try:
+            success = self.__sender.multiSend(commands) is not False
+        except Exception as e:
+            print(f"ERROR: {e}")
+            success = False
+
+        if not success and not self.__sender.connected:
+            return False # the link dropped (a failed write disconnects too), so keep these jobs for replay
+
+        for job in jobs:
+            job[3].partSent(success, self.__sender.lastWriteTime)
+            if not success:
+                self.__errorCallback(job[3].commands)
+        return True
+
+    def replayBuffered(self, jobs):
+        # wait for the link to come back, then send everything issued while it was down in the order it was issued
+        self.__sender.waitForConnection()
+        self.__sender.prepareLink() # straight away, so the radio group is restored even if nothing is waiting to be sent
+        while not self.__queue.empty():
+            jobs.append(self.__queue.get())
+        jobs.sort(key=lambda job: job[1])
+
+        for i, job in enumerate(jobs):
+            if not self.send([job]):
+                return jobs[i:]
+        return []
+
+    def run(self):
+        buffered = []
+        while True:
+            if buffered or not self.__sender.connected:
+                buffered = self.replayBuffered(buffered)
+                continue
+
+            jobs = self.collect(self.__queue.get())
+            if not self.send(jobs):
+                buffered.extend(jobs)
+
+class BuzzerRoster:
+    STATES = ("inactive", "waiting", "active", "locked")
+    DEAD_AFTER = 3.5 # seconds without a presence reply before a buzzer is flagged, just over three missed heartbeats
+    NO_TEAM = 255
+
+    def __init__(self):
+        self.__buzzers = {} # pin index -> (team ID, state, firmware version, time last seen)
+
+    def update(self, pinIndex, teamID, state, version):
+        self.__buzzers[pinIndex] = (teamID, state, version, perf_counter())
+
+    def clear(self):
+        self.__buzzers = {}
+
+    def rows(self, expected):
+        # (pin index, expected alias, reported team, state, firmware version, last seen age, problem) for every buzzer that is expected or has replied
+        rows = []
+        now = perf_counter()
+        for pinIndex in sorted(set(expected) | set(self.__buzzers)):
+            alias = expected[pinIndex][1] if pinIndex in expected else ""
+            if pinIndex not in self.__buzzers:
+                rows.append((pinIndex, alias, "", "", "", None, "Never seen"))
+                continue
+
+            teamID, state, version, lastSeen = self.__buzzers[pinIndex]
+            age = now - lastSeen
+            if age > self.DEAD_AFTER:
+                problem = "Not responding"
+            elif pinIndex in expected and teamID != expected[pinIndex][0]:
+                problem = "Wrong team"
+            elif pinIndex not in expected and teamID != self.NO_TEAM:
+                problem = "Not in setup"
+            else:
+                problem = ""
+
+            teamString = "None" if teamID == self.NO_TEAM else str(teamID)
+            stateString = self.STATES[state] if state < len(self.STATES) else str(state)
+            rows.append((pinIndex, alias, teamString, stateString, str(version), age, problem))
+        return rows
+
+class EventPump:
+    INTERVAL = 8 # ms between drains, so an event waits at most half a frame at 60 Hz
+    MAX_BATCH = 64 # events run per drain, leaving Tk time to redraw during a burst
+    FRAME_TIME = 1 / 60
+
+    def __init__(self, widget, latencyMonitor):
+        self.__widget = widget
+        self.__latencyMonitor = latencyMonitor
+        self.__queue = queue.SimpleQueue() # events are posted from the serial and far throw threads, and only run on the Tk thread
+        self.__draining = False
+
+        self.maxDepth = 0
+        self.eventsRun = 0
+        self.lateEvents = 0 # events that waited longer than a frame before running
+
+    def post(self, function, *args):
+        self.__queue.put((perf_counter(), function, args))
+
+    @property
+    def depth(self):
+        return self.__queue.qsize()
+
+    def start(self):
+        self.__widget.after(self.INTERVAL, self.drain)
+
+    def drain(self):
+        # the next drain is scheduled first, so the pump keeps running whatever a handler does
+        self.__widget.after(self.INTERVAL, self.drain)
+        self.maxDepth = max(self.maxDepth, self.depth)
+
+        # a handler's modal dialog runs a nested Tk loop, which calls drain again, so events wait until the handler returns rather than running inside it
+        if self.__draining:
+            return
+        self.__draining = True
+        try:
+            self.runBatch()
+        finally:
+            self.__draining = False
+
+    def runBatch(self):
+        for i in range(self.MAX_BATCH):
+            try:
+                posted, function, args = self.__queue.get_nowait()
+            except queue.Empty:
+                break
+
+            waited = perf_counter() - posted
+            self.__latencyMonitor.record("event pump", "posted -> run", waited)
+            self.eventsRun += 1
+            if waited > self.FRAME_TIME:
+                self.lateEvents += 1
+
+            try:
+                function(*args)
+            except Exception as e:
+                print(f"ERROR: {e}")
+
 class CommandSendController:
-    def __init__(self, externalReadCallback):
+    def __init__(self, externalReadCallback, errorCallback, statusCallback, latencyMonitor, eventTimeline):
         self.__useSerial = messagebox.askyesno("Select Command Send Mode", "Use serial connection to send commands [Yes] or far throw [No]?")
         
         if self.__useSerial:
-            self.__sender = SerialController(self.readCallback)
+            self.__sender = SerialController(self.readCallback, statusCallback, port=getenv("BUZZER_CONTROLLER_PORT"), latencyMonitor=latencyMonitor)
+            statusCallback("Disconnected", False)
         else:
             self.__sender = FarThrowServer(self.readCallback)
+            statusCallback("Far Throw", True)
             
         self.__externalReadCallback = externalReadCallback
+        self.__commandQueue = CommandQueue(self.__sender, errorCallback)
+
+        self.__latencyMonitor = latencyMonitor
+        self.__eventTimeline = eventTimeline
+        self.__inputTime = None
+
+    def markInput(self):
+        # called at the start of a UI callback, so its commands are timed from the click rather than from the send
+        self.__inputTime = perf_counter()
+
+    def trace(self, commands):
+        trace = self.__latencyMonitor.trace(CommandID.name(commands), "callback", self.__inputTime)
+        self.__inputTime = None
+        trace.mark("queued")
+        return trace
     
-    def singleSend(self, command):
-        self.__sender.singleSend(command)
+    def singleSend(self, command, callback=None):
+        return self.__commandQueue.put([command], callback, self.trace([command]))
         
-    def multiSend(self, commands):
-        self.__sender.multiSend(commands)
+    def multiSend(self, commands, callback=None):
+        return self.__commandQueue.put(commands, callback, self.trace(commands))
+
+    def setRadioGroup(self, radioGroup):
+        if self.__useSerial:
+            self.__sender.radioGroup = radioGroup
+
+    @property
+    def coalesceStats(self):
+        coalescer = self.__commandQueue.coalescer
+        return coalescer.commandsSaved, coalescer.bytesSaved
         
-    def readCallback(self, data):
-        self.__externalReadCallback(data)
+    def readCallback(self, data, received=None):
+        self.__eventTimeline.record(data, received)
+        if data.startswith("ev "): # timeline events only go to the file, so they don't load the UI thread
+            return
+
+        words = data.split()
+        trace = self.__latencyMonitor.trace(f"line: {words[0] if words else ''}", "received", received)
+        trace.mark("dispatched")
+        self.__externalReadCallback(data, trace)
     
     def startThread(self):
         self.__sender.start()
+        self.__commandQueue.start()
         
     def sendUpdate(self, questionManager, teams, bigPicture):
         if not isinstance(self.__sender, FarThrowServer):
@@ -665,6 +994,8 @@ class CommandSendController:
 class Color:
     WHITE = "#FFF"
     BLACK = "#000"
+    CONNECTED = "#00AA00"
+    DISCONNECTED = "#FF0000"
 
     @staticmethod
     def HEXtoRGB(value):
@@ -695,10 +1026,24 @@ class BuzzerControlApp:
 
         self.showBuzzerClosedFrame()
 
-        self.__sendController = CommandSendController(self.readCallback)
+        self.__latencyMonitor = LatencyMonitor()
+        self.__lastBuzzRanking = "none"
+        self.__controllerStats = {"loop": "not requested", "retransmits": "not requested", "group": "not reported"}
+        self.__noAcks = {} # buzzers the controller gave up retransmitting to, and how often
+        self.__reboots = {} # buzzers that have announced a restart, and how often
+        self.__radioSurvey = RadioSurvey()
+        self.__falseStarts = {} # buzzers that locked themselves for pressing within the lockout, and how often
+        self.__falseStartLockout = 0 # ms after an open that a press locks the buzzer, 0 for off
+        self.__answerTimeout = 0 # ms after an open that the controller closes the buzzers if nobody has buzzed, 0 for off
+        self.__buzzerTimings = {} # pin index -> (us from noticing a press to sending it, longest loop us, duplicate packets dropped), from the last diagnostic request
+        self.__roster = BuzzerRoster()
+        self.__eventTimeline = EventTimeline()
+        self.__eventPump = EventPump(self.mainwindow, self.__latencyMonitor)
+        self.__sendController = CommandSendController(self.queueReadCallback, self.commandSendFailed, self.controllerStatusChanged, self.__latencyMonitor, self.__eventTimeline)
 
         self.__db = sqlite3.connect(PROJECT_PATH / "assets" / "buzzer.db")
         self.__cursor = self.__db.cursor()  # type: ignore
+        self.migrateDatabase()
 
         self.__questionManager = QuestionManager(self.__db, self.__cursor)
         self.__teamController = TeamController(self.__questionManager, self.sendScoreUpdate)
@@ -736,10 +1081,32 @@ class BuzzerControlApp:
         self.__soundboardWidget.pack(padx=5, pady=5, expand=True, fill="both")
 
     def run(self):
+        self.__eventPump.start()
         self.__sendController.startThread()
 
         self.mainwindow.mainloop()
         
+    def runOnMainThread(self, function, *args):
+        self.__eventPump.post(function, *args)
+
+    def queueReadCallback(self, string, trace=None):
+        # controller lines arrive on the serial or far throw thread, so they are handled on the Tk thread by the event pump
+        self.runOnMainThread(self.readCallback, string, trace)
+
+    def commandSendFailed(self, commands):
+        self.runOnMainThread(messagebox.showerror, "Controller Communication Error", f"The controller did not acknowledge the commands sent to it ({len(commands)} commands).")
+
+    def controllerStatusChanged(self, status, connected):
+        self.runOnMainThread(self.updateControllerStatusLabel, status, connected)
+
+    def updateControllerStatusLabel(self, status, connected):
+        self.builder.get_object("controllerStatusLabel").configure(
+            text=f"Controller: {status}", text_color=Color.CONNECTED if connected else Color.DISCONNECTED)
+
+    def teamConfigurationSent(self, future):
+        if future.result():
+            self.runOnMainThread(messagebox.showinfo, "Team Setup", "The team configuration was successfully sent to device.")
+
     def sendScoreUpdate(self, teams):
         self.__sendController.sendScores(teams)
         
@@ -974,6 +1341,13 @@ class BuzzerControlApp:
         
         self.__db.commit()
         
+    def migrateDatabase(self):
+        # columns added since the database was first shipped, so older copies keep working
+        self.__cursor.execute("PRAGMA table_info(Configuration)")
+        if "RadioGroup" not in [column[1] for column in self.__cursor.fetchall()]:
+            self.__cursor.execute(f"ALTER TABLE Configuration ADD COLUMN RadioGroup INTEGER DEFAULT {DEFAULT_RADIO_GROUP}")
+            self.__db.commit()
+
     def loadTeamConfigurationPrompt(self, customCallback=None):
         self.__cursor.execute("SELECT ID, Name FROM Configuration")
         configList = self.__cursor.fetchall()
@@ -990,6 +1364,10 @@ class BuzzerControlApp:
     def loadTeamConfiguration(self, value):
         configID = int(value.split()[0])
 
+        self.__cursor.execute(
+            "SELECT RadioGroup FROM Configuration WHERE ID = ?", (configID,))
+        radioGroup = self.__cursor.fetchone()[0]
+
         self.__cursor.execute(
             "SELECT ID, Name, PaletteID FROM TeamConfig WHERE ConfigID = ?", (configID,))
         teams = self.__cursor.fetchall()
@@ -1011,9 +1389,12 @@ class BuzzerControlApp:
             teamData = (team[1], colors, paletteID, teamBuzzers)
             configData.append(teamData)
 
-        self.__teamSetupWidget.loadConfig(configData)
+        self.__teamSetupWidget.loadConfig(configData, radioGroup)
 
     def saveTeamConfiguration(self, config):
+        if config[3] is None:
+            return # setupTeams has already reported the invalid radio group
+
         inputDialog = ctk.CTkInputDialog(
             title="Configuration Name", text="Name your Configuration")
     
@@ -1031,6 +1412,8 @@ class BuzzerControlApp:
                 self.__cursor.execute(
                     "SELECT ID FROM Configuration WHERE Name = ?", (name,))
                 configID = self.__cursor.fetchone()[0]
+                self.__cursor.execute(
+                    "UPDATE Configuration SET RadioGroup = ? WHERE ID = ?", (config[3], configID))
 
                 self.__cursor.execute(
                     "SELECT ID FROM TeamConfig WHERE ConfigID = ?", (configID,))
@@ -1043,7 +1426,7 @@ class BuzzerControlApp:
                 return
         else:
             self.__cursor.execute(
-                "INSERT INTO Configuration (Name) VALUES (?)", (name,))
+                "INSERT INTO Configuration (Name, RadioGroup) VALUES (?, ?)", (name, config[3]))
             self.__cursor.execute(
                 "SELECT last_insert_rowid() FROM Configuration")
             configID = self.__cursor.fetchone()[0]
@@ -1065,30 +1448,35 @@ class BuzzerControlApp:
 
         self.__db.commit()  # type: ignore
 
-    def setupTeams(self, teams):
+    def setupTeams(self, teams, radioGroup):
+        if radioGroup is None:
+            messagebox.showerror("Team Setup Error", "The radio group must be a whole number from 0 to 255.")
+            return
+
         if self.__teamController.scores_exist():
             if not messagebox.askokcancel("Score Reset Warning", "The current scores are not zero. Sending a new configuration will reset the scores to zero. Are you sure you wish to continue?"):
                 return
             
-        commands = self.__teamController.setupTeams(teams)
+        commands = self.__teamController.setupTeams(teams, radioGroup)
+        self.__sendController.setRadioGroup(radioGroup)
         teamData = self.__teamController.getTeamStrings()
         self.builder.get_object(
             "buzzerControlClosedTeamSelect").configure(values=teamData)
 
-        self.__sendController.multiSend(commands)
+        self.__sendController.multiSend(commands, self.teamConfigurationSent)
         
         if len(teamData) > 0:
             self.builder.get_object(
                 "buzzerControlClosedTeamSelect").set(teamData[0])
             
         self.__teamController.updateScoreboards()
-        messagebox.showinfo("Team Setup", "The team configuration was successfully sent to device.")
         
     def restartSet(self):
         nextQ = self.__questionManager.restartSet()
         self.handleNextQuestion(nextQ)
 
     def destroy(self):
+        self.__eventTimeline.stop()
         self.builder.get_object("rootFrame").destroy()
 
     def updateRoundLabel(self):
@@ -1207,12 +1595,37 @@ class BuzzerControlApp:
         self.handleNextQuestion(nextQuestion)
 
     def buzzerClose(self):
+        self.__sendController.markInput()
         self.__sendController.singleSend(f"{CommandID.CLOSE}")
         self.showBuzzerClosedFrame()
         self.clearActiveBuzzer()
 
+    def openCommand(self, command):
+        # the lockout and timeout follow the open's arguments as two bytes each, so the buzzers and controller time them without waiting on the host
+        if self.__falseStartLockout == 0 and self.__answerTimeout == 0:
+            return command
+        return f"{command} {self.__falseStartLockout & 0xFF} {self.__falseStartLockout >> 8} {self.__answerTimeout & 0xFF} {self.__answerTimeout >> 8}"
+
+    def setOpenTimers(self):
+        values = []
+        for title, text, current in (("False Start Lockout", "Lock buzzers pressed within this many ms of opening", self.__falseStartLockout),
+                                     ("Answer Timeout", "Close the buzzers if nobody buzzes within this many ms of opening", self.__answerTimeout)):
+            inputDialog = ctk.CTkInputDialog(title=title, text=f"{text} (0 for off, currently {current})")
+            value = inputDialog.get_input()
+            if value is None:
+                return
+
+            value = value.strip()
+            if not value.isdigit() or int(value) > 0xFFFF:
+                messagebox.showerror("Value Error", "Times must be whole numbers of ms, from 0 to 65535.")
+                return
+            values.append(int(value))
+
+        self.__falseStartLockout, self.__answerTimeout = values
+
     def buzzerOpenAll(self):
-        self.__sendController.singleSend(f"{CommandID.OPEN}")
+        self.__sendController.markInput()
+        self.__sendController.singleSend(self.openCommand(f"{CommandID.OPEN}"))
         self.showBuzzerOpenFrame()
         self.clearActiveBuzzer()
         
@@ -1311,29 +1724,33 @@ class BuzzerControlApp:
             messagebox.showerror("Value Error", "Team must be selected.")
             return
 
+        self.__sendController.markInput()
         teamID = int(selectValue.split(" - ")[0])
-        self.__sendController.singleSend(f"{CommandID.OPEN_TEAM} {teamID}")
+        self.__sendController.singleSend(self.openCommand(f"{CommandID.OPEN_TEAM} {teamID}"))
         self.showBuzzerOpenFrame()
 
         self.clearActiveBuzzer()
 
     def buzzerOpenLockInd(self):
+        self.__sendController.markInput()
         self.__sendController.singleSend(
-            f"{CommandID.OPEN_LOCK_IND} {self.__teamController.getActivePinIndex()}")
+            self.openCommand(f"{CommandID.OPEN_LOCK_IND} {self.__teamController.getActivePinIndex()}"))
         self.showBuzzerOpenFrame()
 
         self.__teamController.applyPenalty()
         self.clearActiveBuzzer()
 
     def buzzerOpenLockTeam(self):
+        self.__sendController.markInput()
         self.__sendController.singleSend(
-            f"{CommandID.OPEN_LOCK_TEAM} {self.__teamController.activeTeam}")
+            self.openCommand(f"{CommandID.OPEN_LOCK_TEAM} {self.__teamController.activeTeam}"))
         self.showBuzzerOpenFrame()
 
         self.__teamController.applyPenalty()
         self.clearActiveBuzzer()
 
     def resetBuzzers(self):
+        self.__sendController.markInput()
         self.__sendController.singleSend(f"{CommandID.RESET_LOCK}")
         self.showBuzzerClosedFrame()
         self.clearActiveBuzzer()
@@ -1364,11 +1781,16 @@ class BuzzerControlApp:
         self.__sendController.singleSend(f"{CommandID.BUZZED} 255")
         self.hostBuzzerTeamPrompt()
 
-    def readCallback(self, string):
+    def readCallback(self, string, trace=None):
+        if trace is not None:
+            trace.mark("drained")
+
         print(string)
         
         data = string.split()
         if len(data) >= 2 and data[0] == "buzzed" and data[1].isdigit():
+            self.__lastBuzzRanking = " ".join(data[1:]) # pin index and ms behind the winner for each press the controller ranked
+
             if int(data[1]) != 255:
                 teamID, buzzerID = self.__teamController.fromPinIndex(int(data[1]))
                 self.buzzed(teamID, buzzerID)
@@ -1379,6 +1801,28 @@ class BuzzerControlApp:
             #self.__macroController.execute(int(data[1])) #! MORE MACRO RELATED THINGS
         elif data[0] == "ERROR:":
             messagebox.showerror("Command Error", string)
+        elif data[0] in self.__controllerStats:
+            self.__controllerStats[data[0]] = " ".join(data[1:]) if len(data) > 1 else "none"
+        elif len(data) >= 5 and data[0] == "presence" and all(value.isdigit() for value in data[1:5]):
+            self.__roster.update(*map(int, data[1:5]))
+        elif len(data) >= 5 and data[0] == "diag" and all(value.isdigit() for value in data[1:5]):
+            self.__buzzerTimings[int(data[1])] = tuple(map(int, data[2:5]))
+        elif len(data) >= 2 and data[0] == "survey" and data[1] == "done":
+            self.__radioSurvey.finish()
+        elif len(data) >= 6 and data[0] == "survey" and all(value.lstrip("-").isdigit() for value in data[1:6]):
+            self.__radioSurvey.update(*map(int, data[1:6]))
+        elif data[0] == "timeout": # the controller has already closed the buzzers
+            self.showBuzzerClosedFrame()
+            self.clearActiveBuzzer()
+        elif len(data) >= 3 and data[0] == "falsestart" and data[1].isdigit() and data[2].isdigit():
+            self.__falseStarts[int(data[1])] = self.__falseStarts.get(int(data[1]), 0) + 1
+        elif len(data) >= 3 and data[0] == "reboot" and data[1].isdigit() and data[2].isdigit():
+            self.buzzerRebooted(int(data[1]))
+        elif len(data) >= 2 and data[0] == "noack" and data[1].isdigit():
+            self.__noAcks[int(data[1])] = self.__noAcks.get(int(data[1]), 0) + 1
+
+        if trace is not None:
+            self.mainwindow.after_idle(trace.finish, "displayed") # runs once Tk has redrawn whatever the line changed
             
     def buzzed(self, teamID, buzzerID):
         self.__teamController.setActive(teamID, buzzerID)
@@ -1424,11 +1868,18 @@ class BuzzerControlApp:
     def buzzerStopIdentifyTeam(self):
         self.__sendController.singleSend(f"{CommandID.IDENTIFY_TEAM} 255")
         
+    def buzzerRebooted(self, pinIndex):
+        self.__reboots[pinIndex] = self.__reboots.get(pinIndex, 0) + 1
+        if len(self.__teamController.teams) == 0: # nothing has been set up yet, so there's nothing to resync
+            return
+
+        # the buzzer restores its saved team at boot, but the setup may have changed while it was off, so always resend its part of it
+        self.__sendController.multiSend(self.__teamController.getBuzzerCommands(pinIndex))
+
     def buzzerFuncResend(self):
         commands = self.__teamController.getCommands()
         if len(commands) >= 0:
-            self.__sendController.multiSend(commands)
-            messagebox.showinfo("Team Setup", "The team configuration was successfully sent to device.")
+            self.__sendController.multiSend(commands, self.teamConfigurationSent)
         else:
             messagebox.showerror("Team Setup Error", "The team configuration is empty, so cannot be sent to device.")
 
@@ -1464,6 +1915,59 @@ class BuzzerControlApp:
         
         controlFrame.pack(expand=True, fill="both")
 
+    def popOutRoster(self):
+        popOut = PopOutWidget(self.mainwindow, "Buzzer Roster")
+
+        rosterWidget = RosterPanel(popOut, self.rosterRows)
+        rosterWidget.pack(expand=True, fill="both")
+
+    def rosterRows(self):
+        return self.__roster.rows(self.__teamController.getExpectedBuzzers())
+
+    def popOutDiagnostics(self):
+        popOut = PopOutWidget(self.mainwindow, "Diagnostics")
+
+        diagnosticsWidget = DiagnosticsPanel(popOut, self.__latencyMonitor, self.__eventTimeline, self.dumpLatencyReport, self.diagnosticsStatus, self.requestControllerStats, self.toggleEventTimeline, self.runRadioSurvey)
+        diagnosticsWidget.pack(expand=True, fill="both")
+
+    def diagnosticsStatus(self):
+        commandsSaved, bytesSaved = self.__sendController.coalesceStats
+        return (f"Event pump: depth {self.__eventPump.depth}, max depth {self.__eventPump.maxDepth}, "
+                f"{self.__eventPump.lateEvents} of {self.__eventPump.eventsRun} events waited over a frame\n"
+                f"Coalescing: {commandsSaved} commands and {bytesSaved} bytes saved\n"
+                f"Last buzz ranking: {self.__lastBuzzRanking}\n"
+                f"Controller loop (iterations, avg us, max us): {self.__controllerStats['loop']}\n"
+                f"Radio retransmits (ID:count): {self.__controllerStats['retransmits']}\n"
+                f"Radio group: {self.__controllerStats['group']}\n"
+                f"Buzzer press to send / longest loop / duplicates dropped (ID:us/us/count): {' '.join(f'{ID}:{pressToSend}/{maxLoop}/{duplicates}' for ID, (pressToSend, maxLoop, duplicates) in sorted(self.__buzzerTimings.items())) or 'not requested'}\n"
+                f"Unacknowledged (ID:count): {' '.join(f'{ID}:{count}' for ID, count in sorted(self.__noAcks.items())) or 'none'}\n"
+                f"Buzzer restarts (ID:count): {' '.join(f'{ID}:{count}' for ID, count in sorted(self.__reboots.items())) or 'none'}\n"
+                f"Radio survey (ID:loss/avg dBm/weakest dBm): {self.__radioSurvey.summary(self.__teamController.getExpectedBuzzers())}\n"
+                f"Open timers: lockout {self.__falseStartLockout} ms, timeout {self.__answerTimeout} ms, false starts (ID:count): {' '.join(f'{ID}:{count}' for ID, count in sorted(self.__falseStarts.items())) or 'none'}")
+
+    def requestControllerStats(self):
+        self.__sendController.multiSend([f"{ControllerCommandID.LOOP_STATS}", f"{ControllerCommandID.RADIO_STATS}", f"{CommandID.DIAGNOSTIC}"])
+
+    def runRadioSurvey(self):
+        self.__radioSurvey.start()
+        self.__sendController.singleSend(f"{ControllerCommandID.RADIO_SURVEY} {RadioSurvey.PINGS}")
+
+    def dumpLatencyReport(self):
+        file = filedialog.asksaveasfilename(title="Save Latency Report", defaultextension=".txt", filetypes=[("Text Files", "*.txt")])
+        if file:
+            self.__latencyMonitor.dump(file)
+
+    def toggleEventTimeline(self):
+        if self.__eventTimeline.recording:
+            self.__sendController.singleSend(f"{ControllerCommandID.SET_TIMELINE} 0")
+            self.__eventTimeline.stop()
+            return
+
+        file = filedialog.asksaveasfilename(title="Save Event Timeline", defaultextension=".tsv", filetypes=[("Tab Separated Values", "*.tsv")])
+        if file:
+            self.__eventTimeline.start(file)
+            self.__sendController.singleSend(f"{ControllerCommandID.SET_TIMELINE} 1")
+
     def popOutScoreboard(self):
         popOut = PopOutWidget(self.mainwindow, "Scoreboard")
         
@@ -0,0 +1,216 @@
+import random
+import threading
+from time import sleep
+
+FRAME_SYNC = 0xFE # never appears as the length byte, so the controller can resynchronise on it after a bad frame
+MAX_PAYLOAD = 60 # keeps a whole frame inside the controller's UART receive buffer
+
+ACK_TIMEOUT = 0.25 # seconds to wait for an ack, on top of the time the controller spends relaying each command
+ACK_TIMEOUT_PER_COMMAND = 0.05
+MAX_ATTEMPTS = 3
+
+# commands from 200 upwards are handled by the controller itself, rather than being relayed to the buzzers
+class ControllerCommandID:
+    SET_BAUD_RATE = 200
+    PING = 201
+    SET_BUZZ_WINDOW = 202 # ms the controller waits after the first buzz to rank any others by press time
+    LOOP_STATS = 203 # the controller prints "loop <iterations> <average us> <max us>" since the last request
+    RADIO_STATS = 204 # the controller prints "retransmits <ID>:<count> ..." for every buzzer it has had to retransmit to
+    SET_HEARTBEAT = 205 # heartbeat interval in tenths of a second (0 for off), the controller prints "presence <ID> <team ID> <state> <firmware version>" for each reply
+    SET_RADIO_GROUP = 206 # moves the buzzers and then the controller to a new radio group, the controller prints "group <group>" once it has switched
+    SET_TIMELINE = 207 # 1 turns on "ev <ticks_ms> <event> <fields...>" lines for every radio packet and frame the controller handles, 0 turns them off
+    RADIO_SURVEY = 208 # sends the given number of pings, then prints "survey <ID> <pings sent> <pings received> <average RSSI> <weakest RSSI>" for each buzzer that reports, and "survey done <pings sent>"
+
+DEFAULT_RADIO_GROUP = 16 # the group the firmware uses unless compiler.py is given another
+
+BAUD_RATES = (9600, 19200, 38400, 57600, 115200, 230400) # SET_BAUD_RATE sends an index into this table
+DEFAULT_BAUD_RATE = 9600
+PREFERRED_BAUD_RATES = (230400, 115200) # tried in order during negotiation, before falling back to the default
+BAUD_SWITCH_DELAY = 0.05 # seconds for the controller to finish sending its ack before both ends switch
+BAUD_REVERT_TIME = 1.0 # the controller returns to the default rate if nothing valid arrives at the new rate within this time
+
+# A frame on the wire is: SYNC, LENGTH, SEQUENCE, PAYLOAD..., CHECKSUM
+# The payload holds one or more commands, each prefixed with its own length: [n, byte1 ... byteN]
+# The checksum is the sum of the length, sequence and every payload byte, modulo 256
+# Once a frame has been relayed the controller replies "ack <sequence>", or "nak <sequence>" if the checksum failed
+
+def parseCommand(command):
+    # convert a command string such as "65 2 255 0 0" into its byte values
+    return bytes(map(int, command.split()))
+
+def checksum(data):
+    return sum(data) & 0xFF
+
+def encodeFrame(sequence, commands):
+    payload = bytearray()
+    for command in commands:
+        payload.append(len(command))
+        payload.extend(command)
+
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Frame payload of {len(payload)} bytes exceeds the maximum of {MAX_PAYLOAD}.")
+
+    header = bytes([FRAME_SYNC, len(payload), sequence])
+    return header + payload + bytes([checksum(header[1:] + payload)])
+
+def groupCommands(commands):
+    # split command strings into runs that each fit in a single frame, keeping their order
+    groups = []
+    currentGroup = []
+    currentSize = 0
+    for command in commands:
+        if command.strip() == "":
+            continue
+
+        try:
+            encoded = parseCommand(command)
+        except ValueError:
+            print(f"ERROR: Invalid command '{command}' was not sent.")
+            continue
+
+        if currentGroup and currentSize + len(encoded) + 1 > MAX_PAYLOAD:
+            groups.append(currentGroup)
+            currentGroup = []
+            currentSize = 0
+
+        currentGroup.append(command)
+        currentSize += len(encoded) + 1
+
+    if currentGroup:
+        groups.append(currentGroup)
+
+    return groups
+
+def decodePayload(payload):
+    commands = []
+    i = 0
+    while i < len(payload):
+        end = i + 1 + payload[i]
+        if payload[i] == 0 or end > len(payload):
+            return None
+        commands.append(bytes(payload[i + 1:end]))
+        i = end
+    return commands
+
+class FrameDecoder:
+    # the same state machine as the controller firmware, for tools that stand in for the controller
+    def __init__(self):
+        self.__state = 0
+        self.__length = 0
+        self.__sequence = 0
+        self.__payload = bytearray()
+
+    def feed(self, data):
+        # returns (sequence, commands) for each complete frame, with commands set to None if the checksum failed
+        # and to an empty list if the checksum passed but the commands were malformed
+        frames = []
+        for value in data:
+            if self.__state == 0:
+                if value == FRAME_SYNC:
+                    self.__state = 1
+            elif self.__state == 1:
+                if 0 < value <= MAX_PAYLOAD:
+                    self.__length = value
+                    self.__payload = bytearray()
+                    self.__state = 2
+                else:
+                    self.__state = 0
+            elif self.__state == 2:
+                self.__sequence = value
+                self.__state = 3
+            elif self.__state == 3:
+                self.__payload.append(value)
+                if len(self.__payload) == self.__length:
+                    self.__state = 4
+            else:
+                self.__state = 0
+                if value == checksum(bytes([self.__length, self.__sequence]) + self.__payload):
+                    commands = decodePayload(self.__payload)
+                    frames.append((self.__sequence, commands if commands is not None else []))
+                else:
+                    frames.append((self.__sequence, None))
+        return frames
+
+def frameSize(commands):
+    # bytes on the wire for a list of command strings, including the framing of every frame they need
+    return sum(4 + sum(len(parseCommand(command)) + 1 for command in group) for group in groupCommands(commands))
+
+class AckTracker:
+    def __init__(self):
+        self.__condition = threading.Condition()
+        self.__sendLock = threading.RLock()
+
+        self.__sequence = random.randrange(256) # so a restarted host is unlikely to repeat the controller's last sequence
+        self.__waitingFor = None
+        self.__result = None
+
+    def nextSequence(self):
+        self.__sequence = (self.__sequence + 1) % 256
+        return self.__sequence
+
+    def expect(self, sequence):
+        with self.__condition:
+            self.__waitingFor = sequence
+            self.__result = None
+
+    def wait(self, timeout):
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.__result is not None, timeout)
+            result = self.__result
+            self.__waitingFor = None
+            return result
+
+    def handleLine(self, line):
+        # returns True if the line was an ack/nak, so it isn't passed on as controller output
+        data = line.split()
+        if len(data) != 2 or data[0] not in ("ack", "nak") or not data[1].isdigit():
+            return False
+
+        with self.__condition:
+            if int(data[1]) == self.__waitingFor:
+                self.__result = data[0]
+                self.__condition.notify_all()
+        return True
+
+    @property
+    def sendLock(self):
+        return self.__sendLock
+
+def sendCommands(commands, writeFrame, ackTracker):
+    # send each frame as soon as the previous one has been acknowledged, retrying on a nak or a timeout
+    with ackTracker.sendLock:
+        for group in groupCommands(commands):
+            sequence = ackTracker.nextSequence()
+            frame = encodeFrame(sequence, [parseCommand(command) for command in group])
+            timeout = ACK_TIMEOUT + ACK_TIMEOUT_PER_COMMAND * len(group)
+
+            for attempt in range(MAX_ATTEMPTS):
+                ackTracker.expect(sequence)
+                if not writeFrame(frame):
+                    return False
+                if ackTracker.wait(timeout) == "ack":
+                    break
+            else:
+                return False
+
+    return True
+
+def negotiateBaudRate(port, writeFrame, ackTracker, rates=PREFERRED_BAUD_RATES):
+    # ask the controller to switch rate, then confirm the link with a ping at the new rate
+    with ackTracker.sendLock:
+        for rate in rates:
+            port.baudrate = DEFAULT_BAUD_RATE
+            if not sendCommands([f"{ControllerCommandID.SET_BAUD_RATE} {BAUD_RATES.index(rate)}"], writeFrame, ackTracker):
+                break
+
+            sleep(BAUD_SWITCH_DELAY)
+            port.baudrate = rate
+            port.reset_input_buffer()
+            if sendCommands([f"{ControllerCommandID.PING}"], writeFrame, ackTracker):
+                return rate
+
+            port.baudrate = DEFAULT_BAUD_RATE
+            sleep(BAUD_REVERT_TIME) # wait for the controller to give up on the new rate too
+
+        port.baudrate = DEFAULT_BAUD_RATE
+        return DEFAULT_BAUD_RATE
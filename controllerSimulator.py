@@ -0,0 +1,195 @@
+import argparse
+import os
+import random
+import threading
+import tty
+from time import perf_counter, sleep
+from commandProtocol import FrameDecoder
+from serialController import SerialController
+
+# Stands in for the controller micro:bit on a pseudo-terminal, so the host serial code can be run and benchmarked on Linux.
+# Standalone: python controllerSimulator.py --buzz-rate 0.5
+#   then start the control app with BUZZER_CONTROLLER_PORT set to the printed port.
+# Benchmark:  python controllerSimulator.py --benchmark
+
+OPENING_COMMANDS = (10, 25, 30, 35)
+OPEN_ARGUMENTS = {10: 0, 25: 1, 30: 1, 35: 1} # arguments before an open's optional lockout and timeout
+CLOSING_COMMANDS = (15, 20, 50, 60, 75, 85, 110)
+
+class SimulatedController(threading.Thread):
+    def __init__(self, buzzerCount=16, relayDelay=0.03):
+        super().__init__(daemon=True)
+
+        self.__master, self.__slave = os.openpty()
+        tty.setraw(self.__slave)
+        self.portName = os.ttyname(self.__slave)
+
+        self.__decoder = FrameDecoder()
+        self.__lock = threading.Lock()
+
+        self.__buzzers = list(range(buzzerCount))
+        self.__relayDelay = relayDelay # seconds the firmware spends relaying each command over radio
+
+        self.__waitingForBuzz = False
+        self.__activeID = None
+        self.__lastSequence = None
+        self.__openCount = 0
+
+        self.framesReceived = 0
+        self.commandsRelayed = 0
+        self.buzzesRejected = 0
+        self.lastBuzzTime = None
+
+    def writeLine(self, line):
+        os.write(self.__master, bytes(line + "\r\n", "utf-8"))
+
+    def run(self):
+        while True:
+            data = os.read(self.__master, 1024)
+            for sequence, commands in self.__decoder.feed(data):
+                self.handleFrame(sequence, commands)
+
+    def handleFrame(self, sequence, commands):
+        if commands is None:
+            self.writeLine(f"nak {sequence}")
+            return
+
+        self.framesReceived += 1
+        if len(commands) > 0 and commands[0][0] in (200, 201): # as the firmware, a baud change or ping always runs
+            self.__lastSequence = None
+        if sequence != self.__lastSequence:
+            self.__lastSequence = sequence
+            if len(commands) == 0:
+                self.writeLine("ERROR: Malformed command in frame.")
+            for command in commands:
+                self.execute(command)
+
+        self.writeLine(f"ack {sequence}")
+
+    def execute(self, command):
+        if command[0] == 208 and len(command) == 2: # a radio survey, where every simulated buzzer hears most of the pings
+            for pinIndex in self.__buzzers:
+                self.writeLine(f"survey {pinIndex} {command[1]} {command[1] - random.randint(0, command[1] // 10)} {random.randint(-75, -45)} {random.randint(-90, -75)}")
+            self.writeLine(f"survey done {command[1]}")
+        if command[0] >= 200: # a pty ignores baud rate changes, and a ping only needs its ack
+            return
+
+        sleep(self.__relayDelay)
+        self.commandsRelayed += 1
+
+        with self.__lock:
+            if command[0] in OPENING_COMMANDS:
+                self.__waitingForBuzz = True
+                self.__activeID = None
+                self.__openCount += 1
+
+                length = 1 + OPEN_ARGUMENTS[command[0]]
+                if len(command) >= length + 4 and command[length + 2] | (command[length + 3] << 8) > 0:
+                    timeout = command[length + 2] | (command[length + 3] << 8)
+                    threading.Timer(timeout / 1000, self.answerTimedOut, (self.__openCount,)).start()
+            elif command[0] in CLOSING_COMMANDS:
+                self.__waitingForBuzz = False
+
+    def answerTimedOut(self, openCount):
+        with self.__lock:
+            if self.__waitingForBuzz and openCount == self.__openCount: # nobody has buzzed, and the buzzers haven't been reopened since
+                self.__waitingForBuzz = False
+                self.writeLine("timeout")
+
+    def buzz(self, pinIndex):
+        # the same arbitration as the firmware: the first buzz after an open wins, and any other buzzer is rejected
+        with self.__lock:
+            if not self.__waitingForBuzz:
+                if self.__activeID is not None and self.__activeID != pinIndex:
+                    self.buzzesRejected += 1
+                return False
+
+            self.__waitingForBuzz = False
+            self.__activeID = pinIndex
+            self.lastBuzzTime = perf_counter()
+            self.writeLine(f"buzzed {pinIndex} +0") # the firmware ranks every press in its window, here there is only ever one
+            return True
+
+    def injectBuzzes(self, rate):
+        # press a random buzzer at random intervals, averaging `rate` presses a second
+        while True:
+            sleep(random.expovariate(rate))
+            self.buzz(random.choice(self.__buzzers))
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {name: samples[min(int(len(samples) * fraction), len(samples) - 1)] * 1000 for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99), ("max", 1.0))}
+
+def formatPercentiles(samples):
+    return ", ".join(f"{name} {value:.3f} ms" for name, value in percentiles(samples).items())
+
+def benchmark(simulator, commandCount, buzzCount):
+    received = threading.Event()
+    buzzLatencies = []
+
+    def readCallback(line, receivedAt):
+        if line.startswith("buzzed"):
+            buzzLatencies.append(perf_counter() - simulator.lastBuzzTime)
+            received.set()
+
+    controller = SerialController(readCallback, lambda status, connected: print(f"Link: {status}"), port=simulator.portName)
+    controller.start()
+    controller.waitForConnection()
+    controller.prepareLink()
+
+    # throughput of single acknowledged commands, the path every open and close takes
+    commandTimes = []
+    start = perf_counter()
+    for i in range(commandCount):
+        sent = perf_counter()
+        controller.singleSend("45")
+        commandTimes.append(perf_counter() - sent)
+    elapsed = perf_counter() - start
+    print(f"Single commands: {commandCount / elapsed:.1f}/s ({formatPercentiles(commandTimes)})")
+
+    # a full team configuration for every simulated buzzer
+    commands = ["110 " + " ".join(str(i % 4) if i < 16 else "255" for i in range(25))]
+    commands.extend(f"65 {teamID} " + " ".join(["255"] * 12) for teamID in range(4))
+    start = perf_counter()
+    controller.multiSend(commands)
+    print(f"Team configuration push ({len(commands)} commands): {(perf_counter() - start) * 1000:.1f} ms")
+
+    # time from the simulator writing "buzzed N" to readCallback receiving it
+    for i in range(buzzCount):
+        controller.singleSend("10")
+        received.clear()
+        simulator.buzz(random.randrange(16))
+        received.wait(1)
+    print(f"Buzz to readCallback: {formatPercentiles(buzzLatencies)}")
+    print(controller.latencyReport())
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated Buzzer System controller on a pseudo-terminal.")
+    parser.add_argument("--buzzers", type=int, default=16, help="number of simulated buzzers")
+    parser.add_argument("--buzz-rate", type=float, default=0.0, help="average synthetic buzzes per second (0 for none)")
+    parser.add_argument("--relay-delay", type=float, default=30.0, help="ms spent relaying each command over radio")
+    parser.add_argument("--benchmark", action="store_true", help="run the host SerialController against the simulator and report timings")
+    parser.add_argument("--commands", type=int, default=200, help="single commands sent during the benchmark")
+    parser.add_argument("--buzzes", type=int, default=200, help="buzzes measured during the benchmark")
+    args = parser.parse_args()
+
+    simulator = SimulatedController(args.buzzers, args.relay_delay / 1000)
+    simulator.start()
+    print(f"Simulated controller on {simulator.portName}")
+
+    if args.buzz_rate > 0:
+        threading.Thread(target=simulator.injectBuzzes, args=(args.buzz_rate,), daemon=True).start()
+
+    if args.benchmark:
+        benchmark(simulator, args.commands, args.buzzes)
+        print(f"Frames received: {simulator.framesReceived}, commands relayed: {simulator.commandsRelayed}, buzzes rejected: {simulator.buzzesRejected}")
+        return
+
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        print(f"Frames received: {simulator.framesReceived}, commands relayed: {simulator.commandsRelayed}, buzzes rejected: {simulator.buzzesRejected}")
+
+if __name__ == "__main__":
+    main()
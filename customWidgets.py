@@ -12,6 +12,7 @@ import win32gui
 import screenshot
 import cv2
 import numpy as np
+from commandProtocol import DEFAULT_RADIO_GROUP
 
 mixer.init()
 
@@ -151,6 +152,97 @@ class Soundboard(ctk.CTkFrame):
     def stop(self):
         mixer.stop()
         
+class DiagnosticsPanel(ctk.CTkFrame):
+    REFRESH_INTERVAL = 1000 # ms between report refreshes
+
+    def __init__(self, master, latencyMonitor, eventTimeline, dumpCallback, statusCallback, requestStatsCallback, timelineCallback, surveyCallback, **kwargs):
+        super().__init__(master, **kwargs)
+
+        self.__latencyMonitor = latencyMonitor
+        self.__eventTimeline = eventTimeline
+        self.__statusCallback = statusCallback
+        self.__timelineCallback = timelineCallback
+
+        self.columnconfigure((0, 1, 2, 3), weight=1)
+        self.rowconfigure(1, weight=1)
+
+        self.statusLabel = ctk.CTkLabel(self, text="", anchor="w", justify="left")
+        self.statusLabel.grid(row=0, column=0, columnspan=4, padx=5, pady=5, sticky="ew")
+
+        self.reportTextbox = ctk.CTkTextbox(self, width=700, height=400, font=ctk.CTkFont("Consolas", 12), wrap="none")
+        self.reportTextbox.grid(row=1, column=0, columnspan=4, padx=5, pady=5, sticky="nsew")
+
+        ctk.CTkButton(self, text="Request Controller Stats", command=requestStatsCallback).grid(row=2, column=0, padx=5, pady=5, sticky="ew")
+        ctk.CTkButton(self, text="Dump to File", command=dumpCallback).grid(row=2, column=1, padx=5, pady=5, sticky="ew")
+        ctk.CTkButton(self, text="Clear Timings", command=self.clear).grid(row=2, column=2, padx=5, pady=5, sticky="ew")
+
+        self.timelineButton = ctk.CTkButton(self, text="", command=self.toggleTimeline)
+        self.timelineButton.grid(row=2, column=3, padx=5, pady=5, sticky="ew")
+
+        ctk.CTkButton(self, text="Run Radio Survey", command=surveyCallback).grid(row=3, column=0, columnspan=4, padx=5, pady=5, sticky="ew")
+
+        self.refresh()
+
+    def refresh(self):
+        if not self.winfo_exists():
+            return
+
+        self.updateReport()
+        self.after(self.REFRESH_INTERVAL, self.refresh)
+
+    def updateReport(self):
+        self.statusLabel.configure(text=self.__statusCallback())
+        if self.__eventTimeline.recording:
+            self.timelineButton.configure(text=f"Stop Timeline ({self.__eventTimeline.eventsWritten} lines)")
+        else:
+            self.timelineButton.configure(text="Record Event Timeline")
+
+        self.reportTextbox.configure(state="normal")
+        self.reportTextbox.delete("1.0", "end")
+        self.reportTextbox.insert("1.0", self.__latencyMonitor.report())
+        self.reportTextbox.configure(state="disabled")
+
+    def clear(self):
+        self.__latencyMonitor.clear()
+        self.updateReport()
+
+    def toggleTimeline(self):
+        self.__timelineCallback()
+        self.updateReport()
+
+class RosterPanel(ctk.CTkFrame):
+    REFRESH_INTERVAL = 500 # ms between roster refreshes
+
+    def __init__(self, master, rowsCallback, **kwargs):
+        super().__init__(master, **kwargs)
+
+        self.__rowsCallback = rowsCallback
+
+        self.rosterTextbox = ctk.CTkTextbox(self, width=700, height=400, font=ctk.CTkFont("Consolas", 12), wrap="none")
+        self.rosterTextbox.pack(padx=5, pady=5, expand=True, fill="both")
+        self.rosterTextbox.tag_config("problem", foreground="red")
+
+        self.refresh()
+
+    def refresh(self):
+        if not self.winfo_exists():
+            return
+
+        self.updateRoster()
+        self.after(self.REFRESH_INTERVAL, self.refresh)
+
+    def updateRoster(self):
+        self.rosterTextbox.configure(state="normal")
+        self.rosterTextbox.delete("1.0", "end")
+        self.rosterTextbox.insert("end", f"{'Pin':>4} {'Buzzer':<30} {'Team':>5} {'State':<9} {'FW':>3} {'Seen (s)':>9}  Problem\n")
+
+        for pinIndex, alias, team, state, version, age, problem in self.__rowsCallback():
+            seen = f"{age:.1f}" if age is not None else "-"
+            line = f"{pinIndex:>4} {alias:<30} {team:>5} {state:<9} {version:>3} {seen:>9}  {problem}\n"
+            self.rosterTextbox.insert("end", line, "problem" if problem else ())
+
+        self.rosterTextbox.configure(state="disabled")
+
 class HostScoreboard(ctk.CTkFrame):
     def __init__(self, master, teamController, showBigPictureCallback, **kwargs):
         super().__init__(master, **kwargs)
@@ -1023,6 +1115,11 @@ class TeamSetup(ctk.CTkScrollableFrame):
         ctk.CTkButton(self.__buttonFrame, text="Identify All", command=identifyAllCallback).grid(row=2, column=0, padx=5, pady=5, sticky="EW")
         ctk.CTkButton(self.__buttonFrame, text="Stop Identify", command=lambda: buzzerIdentifyCallback(255)).grid(row=2, column=1, padx=5, pady=5, sticky="EW")        
         
+        ctk.CTkLabel(self.__buttonFrame, text="Radio Group (0-255, one per system in the room)").grid(row=3, column=0, padx=5, pady=5, sticky="W")
+        self.__radioGroupEntry = ctk.CTkEntry(self.__buttonFrame)
+        self.__radioGroupEntry.grid(row=3, column=1, padx=5, pady=5, sticky="EW")
+        self.setRadioGroup(DEFAULT_RADIO_GROUP)
+        
         self.__buzzerFrame = ctk.CTkFrame(self)
         self.__buzzerFrame.grid(row=1, column=0, padx=5, pady=5, sticky="nsew")
         
@@ -1105,7 +1202,7 @@ class TeamSetup(ctk.CTkScrollableFrame):
             teamIndex = teamNames.index(teamName)
             self.__teams[teamIndex][2].append(buzzerData)
             
-        self.__setConfCallback(self.__teams)
+        self.__setConfCallback(self.__teams, self.getRadioGroup())
         
     def clear(self):
         for element in self.__teamElements:
@@ -1128,10 +1225,21 @@ class TeamSetup(ctk.CTkScrollableFrame):
             currentTeamBuzzers = [(buzzer[0], i, buzzer[1]) for buzzer in team[2]]
             buzzers.extend(currentTeamBuzzers)
         
-        return teamNames, buzzers, teamColors
+        return teamNames, buzzers, teamColors, self.getRadioGroup()
+    
+    def getRadioGroup(self):
+        group = self.__radioGroupEntry.get().strip()
+        if group.isdigit() and int(group) <= 255:
+            return int(group)
+        return None
+    
+    def setRadioGroup(self, group):
+        self.__radioGroupEntry.delete(0, tk.END)
+        self.__radioGroupEntry.insert(0, str(group))
     
-    def loadConfig(self, config):
+    def loadConfig(self, config, radioGroup=DEFAULT_RADIO_GROUP):
         self.clear()
+        self.setRadioGroup(radioGroup)
         for team in config:
             self.newTeam(team[0], team[1], team[2])
             for buzzer in team[3]:
@@ -0,0 +1,49 @@
+import threading
+from time import perf_counter, strftime
+
+class EventTimeline:
+    # writes every controller line to a file while recording, so what happened on air can be pieced together afterwards
+    # each row is: host ms since recording started, controller ticks_ms ("-" for lines that aren't "ev" lines), then the event and its fields
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__file = None
+        self.__startTime = None
+        self.eventsWritten = 0
+
+    @property
+    def recording(self):
+        return self.__file is not None
+
+    def start(self, file):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+
+            self.__file = open(file, "a", buffering=1) # line buffered, so a crash loses at most the line being written
+            self.__startTime = perf_counter()
+            self.eventsWritten = 0
+            self.__file.write(f"# Event timeline started at {strftime('%Y-%m-%d %H:%M:%S')}\n# host ms\tcontroller ms\tevent\tfields\n")
+
+    def record(self, line, received=None):
+        words = line.split()
+        if len(words) == 0:
+            return
+
+        if words[0] == "ev" and len(words) >= 3:
+            controllerTime, fields = words[1], words[2:]
+        else:
+            controllerTime, fields = "-", words
+
+        with self.__lock:
+            if self.__file is None:
+                return
+
+            hostTime = ((received if received is not None else perf_counter()) - self.__startTime) * 1000
+            self.__file.write(f"{hostTime:.3f}\t{controllerTime}\t" + "\t".join(fields) + "\n")
+            self.eventsWritten += 1
+
+    def stop(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
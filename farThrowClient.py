@@ -1,9 +1,10 @@
 import socketio as sio
-from time import sleep
 import serial
 import serial.tools.list_ports as list_ports
 from serial import serialutil
 import logging
+import threading
+from commandProtocol import AckTracker, sendCommands, negotiateBaudRate, DEFAULT_BAUD_RATE, PREFERRED_BAUD_RATES
 import customtkinter as ctk
 from os import path
 from PIL import ImageTk
@@ -16,10 +17,21 @@ BLUE = "#0000FF"
 BLACK = "#000000"
 
 class SerialController:
+    def __init__(self, baudRates=PREFERRED_BAUD_RATES):
+        self.__ackTracker = AckTracker()
+        self.__baudRates = baudRates
+
     def attemptConnection(self):
-        self.__port = self.findCOMport(516, 3368, 9600)
+        self.__port = self.findCOMport(516, 3368, DEFAULT_BAUD_RATE)
+        if self.__port.is_open:
+            # negotiate off the Tk thread, which has to keep polling for the acks
+            threading.Thread(target=self.negotiateBaudRate, daemon=True).start()
         return self.__port.is_open
 
+    def negotiateBaudRate(self):
+        rate = negotiateBaudRate(self.__port, self.writeFrame, self.__ackTracker, self.__baudRates)
+        logging.info(f"Micro:bit link running at {rate} baud.")
+
     def findCOMport(self, PID, VID, baud):
         serPort = serial.Serial(baudrate=baud)
 
@@ -43,9 +55,9 @@ class SerialController:
     def getLine(self):
         return self.__port.readline().decode("utf-8")
 
-    def write(self, command):
+    def writeFrame(self, frame):
         try:
-            self.__port.write(bytes((command + "\n"), "utf-8"))
+            self.__port.write(frame)
             return True
         except Exception as e:
             print(f"An error occured. Try restarting the application. {e}")
@@ -53,33 +65,22 @@ class SerialController:
 
     def single(self, command):
         logging.debug("Received SINGLE: " + command)
-        self.write(command)
+        self.send([command])
         
     def multi(self, commands):
-        commandString = ";".join(commands)
-        logging.debug("Received MULTI: " + commandString)
-        if len(commandString) > 50:              
-            separatedCommands = [commands[0]]
-            currentIndex = 0
-            for command in commands[1:]:
-                if len(separatedCommands[currentIndex]) + len(command) + 1 > 50:
-                    currentIndex += 1
-                    separatedCommands.append(command)
-                else:
-                    separatedCommands[currentIndex] += f";{command}"
-                    
-            for smallCommand in separatedCommands:
-                if not self.write(smallCommand):
-                    break
-                sleep(0.5)
-        else:
-            self.write(commandString)
+        logging.debug("Received MULTI: " + ";".join(commands))
+        self.send(commands)
+
+    def send(self, commands):
+        if not sendCommands(commands, self.writeFrame, self.__ackTracker):
+            logging.error("The Micro:bit did not acknowledge the commands sent to it.")
 
     def checkInput(self):
         try:
             if self.checkBuffer():
                 data = self.getLine()
-                return data
+                if not self.__ackTracker.handleLine(data):
+                    return data
         except Exception:
             return 400
 
@@ -0,0 +1,340 @@
+import argparse
+import io
+import sys
+import time
+import types
+from os import path
+from time import perf_counter
+from commandProtocol import encodeFrame, parseCommand
+
+# Runs the micro:bit firmware unmodified under CPython, with stand-ins for the microbit, radio, neopixel and time modules.
+# Scripted radio packets and UART frames are fed in, and every main loop iteration is timed, so firmware changes can be compared without hardware.
+# Usage: python firmwareBenchmark.py [--firmware buzzer|host|controller|all] [--duration 3] [--interval 5]
+# Times are CPython times, so compare them with each other rather than with a real micro:bit.
+
+FIRMWARE_DIRECTORY = path.join(path.dirname(path.abspath(__file__)), "Microbit", "src")
+FIRMWARE_FILES = {
+    "buzzer": "buzzer.py",
+    "host": "buzzer_host.py",
+    "controller": "controller.py"
+}
+
+class StopBenchmark(Exception):
+    pass
+
+class Pin:
+    def __init__(self):
+        self.value = 0
+
+    def read_digital(self):
+        return self.value
+
+    def write_digital(self, value):
+        pass
+
+class Button:
+    def __init__(self):
+        self.pressed = False
+
+    def is_pressed(self):
+        return self.pressed
+
+    def was_pressed(self):
+        pressed = self.pressed
+        self.pressed = False
+        return pressed
+
+class Display:
+    def show(self, *args, **kwargs):
+        pass
+
+    def scroll(self, *args, **kwargs):
+        pass
+
+    def clear(self):
+        pass
+
+class NeoPixel:
+    def __init__(self, pin, pixelCount):
+        self.__pixels = [(0, 0, 0)] * pixelCount
+        self.shows = 0
+
+    def __setitem__(self, index, color):
+        self.__pixels[index] = color
+
+    def __getitem__(self, index):
+        return self.__pixels[index]
+
+    def show(self):
+        self.shows += 1
+
+class Uart:
+    def __init__(self, benchmark):
+        self.__benchmark = benchmark
+        self.__data = bytearray()
+
+    def init(self, baudrate=9600, **kwargs):
+        pass
+
+    def feed(self, data):
+        self.__data.extend(data)
+
+    def any(self):
+        return len(self.__data)
+
+    def readinto(self, buffer):
+        count = min(len(buffer), len(self.__data))
+        buffer[:count] = self.__data[:count]
+        del self.__data[:count]
+        return count
+
+    def write(self, data):
+        self.__benchmark.linesWritten += 1
+
+class MemoryFile(io.StringIO):
+    # the micro:bit's flash filesystem, kept in memory so the benchmark never writes into the working directory
+    def __init__(self, files, name, mode):
+        super().__init__(files.get(name, "") if "r" in mode else "")
+        self.__files = files
+        self.__name = name
+        self.__mode = mode
+
+    def close(self):
+        if "w" in self.__mode and not self.closed:
+            self.__files[self.__name] = self.getvalue()
+        super().close()
+
+class Radio:
+    def __init__(self, benchmark):
+        self.__benchmark = benchmark
+
+    def config(self, **kwargs):
+        pass
+
+    def on(self):
+        pass
+
+    def off(self):
+        pass
+
+    def send_bytes(self, data):
+        self.__benchmark.packetsSent += 1
+
+    def receive_bytes(self):
+        # every firmware main loop checks the radio once per iteration, so this is where iterations are counted
+        return self.__benchmark.nextIteration()
+
+    def receive_full(self):
+        packet = self.__benchmark.nextIteration()
+        return (packet, -60, int(time.monotonic() * 1000000)) if packet is not None else None
+
+class FirmwareBenchmark:
+    def __init__(self, path, events, interval, duration, replace=None):
+        self.__path = path
+        self.__events = events # (label, kind, data), where kind is "radio", "uart" or "press"
+        self.__interval = interval / 1000
+        self.__duration = duration
+        self.__replace = replace
+
+        self.__timings = {}
+        self.__label = "startup"
+        self.__eventIndex = 0
+        self.__iterationStart = None
+        self.__nextEventAt = None
+        self.__endAt = None
+
+        self.iterations = 0
+        self.elapsed = 0
+        self.packetsSent = 0
+        self.linesWritten = 0
+        self.files = {}
+
+        self.pin1 = Pin()
+        self.buttonA = Button()
+        self.uart = Uart(self)
+        self.radio = Radio(self)
+
+    def record(self, label, duration):
+        if label not in self.__timings:
+            self.__timings[label] = []
+        self.__timings[label].append(duration)
+
+    def nextIteration(self):
+        now = perf_counter()
+        if self.__iterationStart is None: # the first call marks the end of startup
+            self.__endAt = now + self.__duration
+            self.__nextEventAt = now
+        else:
+            self.record(self.__label, now - self.__iterationStart)
+            self.iterations += 1
+
+        if now >= self.__endAt:
+            raise StopBenchmark()
+
+        self.__label = "idle"
+        self.pin1.value = 0
+
+        packet = None
+        if now >= self.__nextEventAt:
+            self.__label, kind, data = self.__events[self.__eventIndex]
+            self.__eventIndex = (self.__eventIndex + 1) % len(self.__events)
+            self.__nextEventAt = now + self.__interval
+
+            if kind == "press": # held for one iteration, read at the top of the next
+                self.pin1.value = 1
+            elif kind == "uart": # read by the controller later in this iteration
+                self.uart.feed(data)
+            else:
+                packet = data
+
+        self.__iterationStart = perf_counter()
+        return packet
+
+    def run(self):
+        microbit = types.ModuleType("microbit")
+        microbit.uart = self.uart
+        microbit.button_a = self.buttonA
+        microbit.button_b = Button()
+        microbit.pin0, microbit.pin1, microbit.pin2 = Pin(), self.pin1, Pin()
+        microbit.display = Display()
+
+        neopixel = types.ModuleType("neopixel")
+        neopixel.NeoPixel = NeoPixel
+
+        radio = types.ModuleType("radio")
+        for name in ("config", "on", "off", "send_bytes", "receive_bytes", "receive_full"):
+            setattr(radio, name, getattr(self.radio, name))
+
+        # MicroPython's time module adds tick counters to the standard one
+        microTime = types.ModuleType("time")
+        microTime.__dict__.update(vars(time))
+        microTime.ticks_ms = lambda: int(time.monotonic() * 1000)
+        microTime.ticks_us = lambda: int(time.monotonic() * 1000000)
+        microTime.ticks_add = lambda ticks, delta: ticks + delta
+        microTime.ticks_diff = lambda end, start: end - start
+        microTime.sleep_ms = lambda ms: time.sleep(ms / 1000)
+        microTime.sleep_us = lambda us: time.sleep(us / 1000000)
+
+        with open(self.__path) as f:
+            source = f.read()
+        if self.__replace is not None: # the same substitution compiler.py makes when flashing a buzzer
+            source = source.replace('"#REPLACE#"', str(self.__replace))
+
+        stubs = {"microbit": microbit, "neopixel": neopixel, "radio": radio, "time": microTime}
+        originals = {name: sys.modules.get(name) for name in stubs}
+        sys.modules.update(stubs)
+        try:
+            exec(compile(source, self.__path, "exec"), {"__name__": "__main__", "print": self.capturePrint, "open": self.openFile})
+        except StopBenchmark:
+            pass
+        finally:
+            for name, module in originals.items():
+                if module is None:
+                    sys.modules.pop(name, None)
+                else:
+                    sys.modules[name] = module
+
+        self.elapsed = self.__duration
+
+    def capturePrint(self, *args, **kwargs):
+        self.linesWritten += 1
+
+    def openFile(self, name, mode="r"):
+        if "r" in mode and name not in self.files:
+            raise OSError(2, "ENOENT")
+        return MemoryFile(self.files, name, mode)
+
+    def report(self):
+        lines = [f"{path.basename(self.__path)}", f"  {self.iterations} loop iterations in {self.elapsed:.1f} s, {self.iterations / self.elapsed:.0f} per second"]
+
+        idle = sorted(self.__timings.get("idle", [0]))
+        idleMean = sum(idle) / len(idle)
+
+        lines.append(f"  {'Iteration':<28} {'Count':>8} {'p50 (us)':>9} {'p99 (us)':>9} {'mean (us)':>10} {'over idle':>10}")
+        for label in ["idle"] + [label for label in self.__timings if label not in ("idle", "startup")]: # scripted messages in the order they're sent
+            if label not in self.__timings:
+                continue
+
+            samples = sorted(self.__timings[label])
+            mean = sum(samples) / len(samples)
+            p50, p99 = (samples[min(int(len(samples) * fraction), len(samples) - 1)] * 1000000 for fraction in (0.5, 0.99))
+            lines.append(f"  {label:<28} {len(samples):>8} {p50:>9.1f} {p99:>9.1f} {mean * 1000000:>10.1f} {(mean - idleMean) * 1000000:>10.1f}")
+
+        lines.append(f"  Radio packets sent: {self.packetsSent}, lines printed: {self.linesWritten}")
+        return "\n".join(lines)
+
+class Sequence:
+    # the controller's radio sequence numbers, 1-255
+    def __init__(self):
+        self.__value = 0
+
+    def next(self, command):
+        self.__value = self.__value % 255 + 1
+        return bytes([self.__value] + command)
+
+    def repeat(self, command):
+        return bytes([self.__value] + command)
+
+def buzzerEvents(buzzerID):
+    # one game round as a buzzer hears it, with the noise a busy radio group adds
+    sequence = Sequence()
+    return [
+        ("roster", "radio", sequence.next([110] + [0] * 25)),
+        ("colour profile", "radio", sequence.next([65, 0] + [255, 165, 0, 0, 0, 255, 0, 255, 0, 0, 0, 0])),
+        ("heartbeat", "radio", bytes([0, 100])),
+        ("open", "radio", sequence.next([10, 0, 0, 0, 0, 0, 0, 3])),
+        ("duplicate open", "radio", sequence.repeat([10, 0, 0, 0, 0, 0, 0, 3])),
+        ("button press", "press", None),
+        ("buzz from another buzzer", "radio", bytes([0, 50, (buzzerID + 1) % 25, 40, 0])),
+        ("buzz answered", "radio", sequence.next([50, buzzerID])),
+        ("ack from another buzzer", "radio", bytes([0, 95, 1, (buzzerID + 1) % 25])),
+        ("diagnostic request", "radio", sequence.next([120])),
+        ("survey ping", "radio", bytes([0, 135, 1, 0])),
+        ("survey report request", "radio", bytes([0, 140, 1])),
+        ("close", "radio", sequence.next([15])),
+        ("reset lock", "radio", sequence.next([20])),
+        ("light update", "radio", sequence.next([45]))
+    ]
+
+def controllerEvents():
+    # host frames and buzzer replies, as the controller sees them during a round
+    frameSequence = Sequence()
+    frame = lambda commands: encodeFrame(frameSequence.next([])[0], [parseCommand(command) for command in commands])
+    return [
+        ("frame: roster", "uart", frame(["110 " + " ".join(str(i % 4) for i in range(25))])),
+        ("frame: colour profiles", "uart", frame([f"65 {teamID} " + " ".join(["255"] * 12) for teamID in range(4)])),
+        ("radio: ack", "radio", bytes([0, 95, 2, 0])),
+        ("radio: presence", "radio", bytes([0, 105, 1, 0, 0, 2])),
+        ("frame: open", "uart", frame(["10 200 0 16 39"])),
+        ("radio: buzz", "radio", bytes([0, 50, 2, 120, 0])),
+        ("radio: second buzz", "radio", bytes([0, 50, 3, 130, 0])),
+        ("radio: repeated buzz", "radio", bytes([0, 50, 2, 120, 0])),
+        ("radio: ack", "radio", bytes([0, 95, 3, 1])),
+        ("radio: reboot", "radio", bytes([0, 130, 4, 1, 3])),
+        ("radio: false start", "radio", bytes([0, 150, 5, 80, 0])),
+        ("radio: survey report", "radio", bytes([0, 145, 2, 0, 95, 60, 72])),
+        ("frame: close", "uart", frame(["15"])),
+        ("frame: loop stats", "uart", frame(["203"]))
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Buzzer System firmware main loops under CPython.")
+    parser.add_argument("--firmware", choices=("buzzer", "host", "controller", "all"), default="all")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds to run each firmware for")
+    parser.add_argument("--interval", type=float, default=5.0, help="ms between scripted messages")
+    parser.add_argument("--buzzer-id", type=int, default=0, help="the ID flashed into buzzer.py")
+    args = parser.parse_args()
+
+    firmwares = ("buzzer", "host", "controller") if args.firmware == "all" else (args.firmware,)
+    for firmware in firmwares:
+        if firmware == "controller":
+            benchmark = FirmwareBenchmark(path.join(FIRMWARE_DIRECTORY, FIRMWARE_FILES[firmware]), controllerEvents(), args.interval, args.duration)
+        else:
+            benchmark = FirmwareBenchmark(path.join(FIRMWARE_DIRECTORY, FIRMWARE_FILES[firmware]), buzzerEvents(args.buzzer_id), args.interval, args.duration, replace=args.buzzer_id)
+
+        benchmark.run()
+        print(benchmark.report())
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import threading
+from collections import deque
+from time import perf_counter, strftime
+
+class LatencyTrace:
+    # timestamps one command (or one controller line) as it passes each stage of the host
+    def __init__(self, monitor, name, stage, timestamp=None):
+        self.__monitor = monitor
+        self.__name = name
+        self.__stages = [(stage, timestamp if timestamp is not None else perf_counter())]
+        self.__finished = False
+
+    @property
+    def name(self):
+        return self.__name
+
+    def mark(self, stage, timestamp=None):
+        self.__stages.append((stage, timestamp if timestamp is not None else perf_counter()))
+
+    def finish(self, stage, timestamp=None):
+        if self.__finished:
+            return
+
+        self.__finished = True
+        self.mark(stage, timestamp)
+        self.__monitor.recordTrace(self.__name, self.__stages)
+
+class LatencyMonitor:
+    WINDOW = 500 # samples kept for each command and stage, so the percentiles follow recent behaviour
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__samples = {}
+
+    def trace(self, name, stage, timestamp=None):
+        return LatencyTrace(self, name, stage, timestamp)
+
+    def recordTrace(self, name, stages):
+        # each stage is timed from the one before it, and "total" from the first stage to the last
+        with self.__lock:
+            for (previousStage, previousTime), (stage, timestamp) in zip(stages, stages[1:]):
+                self.__addSample(name, f"{previousStage} -> {stage}", timestamp - previousTime)
+            self.__addSample(name, "total", stages[-1][1] - stages[0][1])
+
+    def record(self, name, stage, latency):
+        with self.__lock:
+            self.__addSample(name, stage, latency)
+
+    def __addSample(self, name, stage, latency):
+        key = (name, stage)
+        if key not in self.__samples:
+            self.__samples[key] = deque(maxlen=self.WINDOW)
+        self.__samples[key].append(latency)
+
+    @staticmethod
+    def percentile(samples, fraction):
+        return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+    def summary(self):
+        # (name, stage, count, p50, p95, p99) in milliseconds, for every stage seen so far
+        with self.__lock:
+            samples = {key: sorted(values) for key, values in self.__samples.items()}
+
+        rows = []
+        for (name, stage), values in sorted(samples.items(), key=lambda item: item[0][0]): # stages stay in the order they happen
+            rows.append((name, stage, len(values), *(self.percentile(values, fraction) * 1000 for fraction in (0.5, 0.95, 0.99))))
+        return rows
+
+    def report(self):
+        rows = self.summary()
+        if len(rows) == 0:
+            return "No commands have been timed yet."
+
+        lines = [f"{'Command':<26} {'Stage':<26} {'Count':>6} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9}"]
+        for name, stage, count, p50, p95, p99 in rows:
+            lines.append(f"{name:<26} {stage:<26} {count:>6} {p50:>9.2f} {p95:>9.2f} {p99:>9.2f}")
+        return "\n".join(lines)
+
+    def dump(self, file):
+        with open(file, "a") as f:
+            f.write(f"Latency report at {strftime('%Y-%m-%d %H:%M:%S')}\n{self.report()}\n\n")
+
+    def clear(self):
+        with self.__lock:
+            self.__samples = {}
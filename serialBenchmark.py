@@ -0,0 +1,87 @@
+import serial
+import sys
+from time import perf_counter
+from commandProtocol import encodeFrame, groupCommands, parseCommand, BAUD_RATES
+
+# Measures config push throughput and line latency over a serial loopback at each baud rate.
+# Usage: python serialBenchmark.py port [repeats]
+# Use a USB-serial adapter with TX and RX bridged, or a socat pty pair with an echo on the far end.
+# pyserial's "loop://" is accepted, but it ignores the baud rate, so it is run once and only shows software and framing overhead.
+# For timings through the host serial code, run controllerSimulator.py --benchmark instead.
+
+BUZZER_COUNT = 16
+TEAM_COUNT = 4
+LATENCY_SAMPLES = 50
+
+def teamConfigurationFrames():
+    commands = ["110 " + " ".join(str(i % TEAM_COUNT) if i < BUZZER_COUNT else "255" for i in range(25))]
+    commands.extend(f"65 {teamID} " + " ".join(["255"] * 12) for teamID in range(TEAM_COUNT))
+
+    return [encodeFrame(sequence, [parseCommand(command) for command in group]) for sequence, group in enumerate(groupCommands(commands))]
+
+def readExactly(port, count):
+    data = bytearray()
+    while len(data) < count:
+        chunk = port.read(count - len(data))
+        if not chunk:
+            raise TimeoutError(f"Loopback returned {len(data)} of {count} bytes.")
+        data.extend(chunk)
+    return data
+
+def measureThroughput(port, frames, repeats):
+    totalBytes = sum(len(frame) for frame in frames) * repeats
+
+    start = perf_counter()
+    for i in range(repeats):
+        for frame in frames:
+            port.write(frame)
+            readExactly(port, len(frame))
+    elapsed = perf_counter() - start
+
+    return totalBytes, elapsed
+
+def measureLatency(port):
+    line = b"buzzed 3\r\n"
+    samples = []
+    for i in range(LATENCY_SAMPLES):
+        start = perf_counter()
+        port.write(line)
+        readExactly(port, len(line))
+        samples.append(perf_counter() - start)
+
+    samples.sort()
+    return samples[len(samples) // 2], samples[-1]
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python serialBenchmark.py port [repeats]")
+        sys.exit(1)
+
+    portName = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    loopback = portName.startswith("loop://")
+
+    frames = teamConfigurationFrames()
+    print(f"Team configuration for {BUZZER_COUNT} buzzers: {len(frames)} frames, {sum(len(frame) for frame in frames)} bytes")
+    if loopback:
+        print("loop:// ignores the baud rate, so these timings are software and framing overhead only, not link speed.")
+    print(f"{'Baud':>8} {'Push (ms)':>10} {'Wire (ms)':>10} {'kB/s':>8} {'Line p50 (ms)':>14} {'Line max (ms)':>14}")
+
+    for rate in BAUD_RATES[-1:] if loopback else BAUD_RATES:
+        port = serial.serial_for_url(portName, baudrate=rate, timeout=2)
+        try:
+            port.reset_input_buffer()
+            totalBytes, elapsed = measureThroughput(port, frames, repeats)
+            lineMedian, lineMax = measureLatency(port)
+        finally:
+            port.close()
+
+        pushTime = elapsed / repeats * 1000
+        wireTime = totalBytes / repeats * 10 / rate * 1000 # 8N1 framing puts 10 bits on the wire per byte
+        if loopback:
+            print(f"{'loop://':>8} {pushTime:>10.2f} {'-':>10} {totalBytes / elapsed / 1000:>8.1f} {lineMedian * 1000:>14.3f} {lineMax * 1000:>14.3f}")
+            continue
+        print(f"{rate:>8} {pushTime:>10.2f} {wireTime:>10.2f} {totalBytes / elapsed / 1000:>8.1f} {lineMedian * 1000:>14.3f} {lineMax * 1000:>14.3f}")
+
+if __name__ == "__main__":
+    main()
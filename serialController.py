@@ -0,0 +1,170 @@
+import serial
+import serial.tools.list_ports as list_ports
+import threading
+from time import perf_counter, sleep
+from commandProtocol import AckTracker, ControllerCommandID, sendCommands, negotiateBaudRate, DEFAULT_BAUD_RATE, PREFERRED_BAUD_RATES
+
+class SerialController(threading.Thread):
+    READ_TIMEOUT = 0.05 # seconds a read may block for before the thread loops again
+    RECONNECT_MIN_DELAY = 0.1 # seconds between reconnect attempts, doubling up to the maximum
+    RECONNECT_MAX_DELAY = 2.0
+
+    def __init__(self, readCallback, statusCallback, baudRates=PREFERRED_BAUD_RATES, port=None, latencyMonitor=None):
+        super().__init__(daemon=True)
+        
+        self.__readBuffer = bytearray()
+        self.__ackTracker = AckTracker()
+        self.__baudRates = baudRates
+        self.__negotiated = False
+        self.__latencyCount = 0
+        self.__latencyTotal = 0.0
+        self.__latencyMax = 0.0
+        self.__latencyMonitor = latencyMonitor # read latency is shown in the diagnostics pop-out, rather than printed
+        self.lastWriteTime = None # when the most recent frame finished being written, for latency traces
+        self.radioGroup = None # the group the host last set, resent on every connection as the controller restarts on its flashed group
+
+        self.__port = None
+        self.__connected = threading.Event()
+        self.__lastDevice = port # a fixed port (e.g. a simulator pty) is tried before scanning
+        self.__lastSerialNumber = None
+        
+        self.__readCallback = readCallback
+        self.__statusCallback = statusCallback
+
+    @property
+    def connected(self):
+        return self.__connected.is_set()
+
+    def waitForConnection(self):
+        self.__connected.wait()
+
+    def attemptConnection(self):
+        port = self.findCOMport(516, 3368, DEFAULT_BAUD_RATE)
+        if not port.is_open:
+            return False
+
+        self.__port = port
+        self.__readBuffer.clear()
+        self.__negotiated = False
+        self.__connected.set()
+        self.__statusCallback("Connected", True)
+        return True
+
+    def findCOMport(self, PID, VID, baud):
+        serPort = serial.Serial(baudrate=baud, timeout=self.READ_TIMEOUT)
+
+        # try the last known device first, so a bumped cable doesn't need a full port scan
+        if self.__lastDevice is not None:
+            try:
+                serPort.port = self.__lastDevice
+                serPort.open()
+                return serPort
+            except serial.SerialException:
+                pass
+
+        ports = [p for p in list_ports.comports() if p.pid == PID and p.vid == VID]
+        ports.sort(key=lambda p: p.serial_number != self.__lastSerialNumber) # prefer the micro:bit we were last connected to
+        for p in ports:
+            try:
+                serPort.port = str(p.device)
+                serPort.open()
+            except serial.SerialException:
+                continue
+
+            self.__lastDevice = serPort.port
+            self.__lastSerialNumber = p.serial_number
+            break
+
+        return serPort
+
+    def disconnect(self):
+        self.__connected.clear()
+        self.__statusCallback("Disconnected", False)
+        try:
+            self.__port.close()
+        except Exception:
+            pass
+
+    def reconnect(self):
+        delay = self.RECONNECT_MIN_DELAY
+        while not self.attemptConnection():
+            self.__statusCallback("Reconnecting", False)
+            sleep(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+    def readLines(self):
+        # block until at least one byte arrives (or the timeout passes), then take everything that is waiting in one read
+        chunk = self.__port.read(max(1, self.__port.in_waiting))
+        if not chunk:
+            return
+        received = perf_counter()
+
+        self.__readBuffer.extend(chunk)
+        lineEnd = self.__readBuffer.find(b"\n")
+        while lineEnd != -1:
+            line = self.__readBuffer[:lineEnd + 1].decode("utf-8", errors="replace")
+            del self.__readBuffer[:lineEnd + 1]
+
+            if not self.__ackTracker.handleLine(line):
+                try:
+                    self.__readCallback(line, received)
+                except Exception as e: # a bug handling one line shouldn't drop the link
+                    print(f"ERROR: Failed to handle line from the controller: {line.strip()!r}. {e}")
+            self.recordLatency(perf_counter() - received) # from the bytes arriving until the line's handler has returned
+
+            lineEnd = self.__readBuffer.find(b"\n")
+
+    def recordLatency(self, latency):
+        self.__latencyCount += 1
+        self.__latencyTotal += latency
+        self.__latencyMax = max(self.__latencyMax, latency)
+
+        if self.__latencyMonitor is not None:
+            self.__latencyMonitor.record("serial read", "received -> handled", latency)
+
+    def latencyReport(self):
+        if self.__latencyCount == 0:
+            return "Serial line latency (received -> handled): no lines received."
+        
+        average = self.__latencyTotal / self.__latencyCount * 1000
+        return f"Serial line latency (received -> handled): avg {average:.3f} ms, max {self.__latencyMax * 1000:.3f} ms over {self.__latencyCount} lines."
+
+    def writeFrame(self, frame):
+        try:
+            self.__port.write(frame)
+            self.lastWriteTime = perf_counter()
+            return True
+        except Exception as e:
+            print(f"ERROR: Failed to write to the controller. {e}")
+            self.disconnect() # the port is gone, so the command queue buffers its jobs until the reader thread reconnects
+            return False
+
+    def prepareLink(self):
+        # called from the writer thread, as negotiating needs the reader thread running to receive acks
+        if not self.__negotiated:
+            self.__negotiated = True
+            rate = negotiateBaudRate(self.__port, self.writeFrame, self.__ackTracker, self.__baudRates)
+            if self.connected:
+                self.__statusCallback(f"Connected ({rate} baud)", True)
+            if self.radioGroup is not None:
+                self.singleSend(f"{ControllerCommandID.SET_RADIO_GROUP} {self.radioGroup}")
+
+    def singleSend(self, string):
+        return self.multiSend([string])
+            
+    def multiSend(self, commands):
+        return sendCommands(commands, self.writeFrame, self.__ackTracker)
+
+    def run(self):
+        while True:
+            if not self.connected:
+                self.reconnect()
+
+            try:
+                self.readLines()
+            except (serial.SerialException, OSError) as e:
+                print(f"Controller connection lost. {e}")
+                self.disconnect()
+            except Exception as e: # e.g. a failed write closing the port part way through a read
+                print(f"ERROR: Unexpected error reading from the controller. {e}")
+                self.disconnect()